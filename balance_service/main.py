@@ -394,6 +394,43 @@ def debit_group_balance(update_in: schemas.GroupBalanceUpdate, db: Session = Dep
         db.rollback()
         raise e
 
+def move_funds_user_group(db: Session, transfer_in: schemas.GroupTransfer, to_group: bool) -> Account:
+    """Mueve fondos entre BDI y BDG en UNA transacción (bloqueo pesimista de ambas cuentas)."""
+    amount = Decimal(str(transfer_in.amount))
+    try:
+        with db.begin():
+            # Orden de bloqueo fijo (BDI -> BDG) para evitar deadlocks entre operaciones cruzadas
+            account = db.query(Account).filter(Account.user_id == transfer_in.user_id).with_for_update().first()
+            if not account:
+                raise HTTPException(status.HTTP_404_NOT_FOUND, "Account not found.")
+            group_account = db.query(GroupAccount).filter(GroupAccount.group_id == transfer_in.group_id).with_for_update().first()
+            if not group_account:
+                raise HTTPException(status.HTTP_404_NOT_FOUND, "Group account not found.")
+
+            source, destination = (account, group_account) if to_group else (group_account, account)
+            if source.balance < amount:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, "Insufficient funds.")
+            source.balance -= amount
+            destination.balance += amount
+        db.refresh(account)
+        return account
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error transfer user<->group: {e}")
+        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Internal error.")
+
+@app.post("/balance/transfer_to_group", response_model=schemas.AccountResponse, tags=["Balance - Grupal"])
+def transfer_to_group(transfer_in: schemas.GroupTransfer, db: Session = Depends(get_db)):
+    """Verifica, debita la BDI y acredita la BDG de forma atómica (aportes)."""
+    return move_funds_user_group(db, transfer_in, to_group=True)
+
+@app.post("/balance/transfer_from_group", response_model=schemas.AccountResponse, tags=["Balance - Grupal"])
+def transfer_from_group(transfer_in: schemas.GroupTransfer, db: Session = Depends(get_db)):
+    """Operación inversa de /balance/transfer_to_group (compensación de aportes)."""
+    return move_funds_user_group(db, transfer_in, to_group=False)
+
 # --- ENDPOINT INTERNO (Stress-test feature) ---
 @app.delete("/accounts/{user_id}", tags=["Internal"])
 def delete_account_internal(user_id: int, db: Session = Depends(get_db)):
@@ -67,4 +67,11 @@ class GroupAccount(BaseModel):
     balance: Decimal
     version: int
     
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+
+class GroupTransfer(BaseModel):
+    """Movimiento atómico de fondos entre una BDI y una BDG."""
+    user_id: int
+    group_id: int
+    amount: float
@@ -7,6 +7,7 @@ import time
 from typing import Dict # Para type hint
 
 from fastapi import FastAPI, HTTPException, status, Header, Depends, Request, Response
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
@@ -30,7 +31,8 @@ if not EXPECTED_API_KEY:
 app = FastAPI(
     title="Interbank Service (Simulador Happy Money)",
     description="Simula la API de Happy Money para recibir transferencias BDI-BDI.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse # Serialización de respuestas con orjson (más rápida que json.dumps)
 )
 
 # --- Métricas Prometheus ---
@@ -1,8 +1,10 @@
 import os
 import logging
 import time
-from cassandra.cluster import Cluster, Session
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster, Session, ExecutionProfile, EXEC_PROFILE_DEFAULT
 from cassandra.auth import PlainTextAuthProvider
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
 from cassandra.query import dict_factory
 
 # Configura logger
@@ -22,11 +24,27 @@ CASSANDRA_HOSTS = _host_env.split(',')
 CASSANDRA_PORT = int(os.getenv("CASSANDRA_PORT", 9042))
 CASSANDRA_USER = os.getenv("CASSANDRA_USER")
 CASSANDRA_PASS = os.getenv("CASSANDRA_PASS")
+# Datacenter local para el enrutamiento (si no se define, el driver lo detecta desde los contact points)
+CASSANDRA_DC = os.getenv("CASSANDRA_DC")
+CASSANDRA_PROTOCOL_VERSION = int(os.getenv("CASSANDRA_PROTOCOL_VERSION", 5))
+CASSANDRA_REQUEST_TIMEOUT = float(os.getenv("CASSANDRA_REQUEST_TIMEOUT", 5.0))
 
 # Variables para Astra DB
 ASTRA_DB_TOKEN = os.getenv("ASTRA_DB_TOKEN")
 ASTRA_DB_SECURE_BUNDLE_PATH = os.getenv("ASTRA_DB_SECURE_BUNDLE_PATH", "secure-connect-bundle.zip")
 
+def _default_profile() -> ExecutionProfile:
+    """
+    Perfil por defecto de la sesión: enrutamiento token-aware dentro del DC local,
+    LOCAL_QUORUM (sin saltos entre DCs) y filas como dict.
+    """
+    return ExecutionProfile(
+        load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=CASSANDRA_DC)),
+        consistency_level=ConsistencyLevel.LOCAL_QUORUM,
+        request_timeout=CASSANDRA_REQUEST_TIMEOUT,
+        row_factory=dict_factory
+    )
+
 # Singleton de la sesión
 cluster = None
 session = None
@@ -58,7 +76,11 @@ def get_cassandra_session() -> Session:
                 }
                 # En Astra, el 'username' siempre es 'token' y el password es tu token real
                 auth_provider = PlainTextAuthProvider('token', ASTRA_DB_TOKEN)
-                cluster = Cluster(cloud=cloud_config, auth_provider=auth_provider)
+                cluster = Cluster(
+                    cloud=cloud_config,
+                    auth_provider=auth_provider,
+                    execution_profiles={EXEC_PROFILE_DEFAULT: _default_profile()}
+                )
             
             # --- MODO 2: CASSANDRA LOCAL (Docker) ---
             else:
@@ -71,14 +93,13 @@ def get_cassandra_session() -> Session:
                     contact_points=CASSANDRA_HOSTS,
                     port=CASSANDRA_PORT,
                     auth_provider=auth_provider,
-                    protocol_version=4
+                    protocol_version=CASSANDRA_PROTOCOL_VERSION,
+                    execution_profiles={EXEC_PROFILE_DEFAULT: _default_profile()}
                 )
 
+            # (row_factory, consistencia y timeout vienen del perfil por defecto)
             session = cluster.connect()
             
-            # Configuración de la sesión
-            session.row_factory = dict_factory 
-            
             # Si es Local, intentamos crear el Keyspace (Astra no lo permite/necesita aquí)
             if not ASTRA_DB_TOKEN:
                 try:
@@ -1,9 +1,11 @@
 """Servicio FastAPI para gestionar el registro de transacciones (Ledger) en Cassandra."""
 
 import os
+import re
+import asyncio
 import httpx
+import orjson
 import uuid
-import json
 import logging
 from datetime import datetime, timedelta, timezone
 from typing import Optional, List
@@ -11,8 +13,10 @@ from collections import defaultdict
 from decimal import Decimal
 
 from fastapi import FastAPI, Depends, HTTPException, status, Header, Request, Response
+from fastapi.responses import ORJSONResponse
 from cassandra.cluster import Session
-from cassandra.query import SimpleStatement, BatchStatement
+from cassandra.query import BatchStatement, BatchType
+from cachetools import TTLCache
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import time
 
@@ -37,7 +41,37 @@ INTERBANK_SERVICE_URL = os.getenv("INTERBANK_SERVICE_URL")
 INTERBANK_API_KEY = os.getenv("INTERBANK_API_KEY")
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL")
 GROUP_SERVICE_URL = os.getenv("GROUP_SERVICE_URL") # ¡El que faltaba!
-KEYSPACE = cassandra_db.KEYSPACE
+# URLs fijas de servicios externos: se parsean una sola vez al importar
+URL_CREDIT = httpx.URL(f"{BALANCE_SERVICE_URL}/balance/credit")
+URL_DEBIT = httpx.URL(f"{BALANCE_SERVICE_URL}/balance/debit")
+URL_CHECK = httpx.URL(f"{BALANCE_SERVICE_URL}/balance/check")
+URL_TRANSFER_TO_GROUP = httpx.URL(f"{BALANCE_SERVICE_URL}/balance/transfer_to_group")
+URL_TRANSFER_FROM_GROUP = httpx.URL(f"{BALANCE_SERVICE_URL}/balance/transfer_from_group")
+URL_GROUP_CREDIT = httpx.URL(f"{BALANCE_SERVICE_URL}/group_balance/credit")
+URL_GROUP_DEBIT = httpx.URL(f"{BALANCE_SERVICE_URL}/group_balance/debit")
+# Destino y cabeceras de Interbank: fijos, se construyen una sola vez
+INTERBANK_URL = httpx.URL(f"{INTERBANK_SERVICE_URL}/interbank/transfers")
+INTERBANK_HEADERS = {"X-API-KEY": INTERBANK_API_KEY, "Content-Type": "application/json"}
+# Cabecera para cuerpos JSON pre-serializados con orjson (content= en lugar de json=)
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Tiempo máximo (segundos) para TODO el bloque de llamadas externas de una transacción
+EXTERNAL_CALLS_DEADLINE = float(os.getenv("EXTERNAL_CALLS_DEADLINE", "5.0"))
+# Escrituras no críticas (estados de fallo) agrupadas en segundo plano
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "50"))
+WRITE_BATCH_DELAY = float(os.getenv("WRITE_BATCH_DELAY_MS", "20")) / 1000
+# Consultas de calentamiento al arrancar (abren las conexiones del pool de Cassandra)
+WARMUP_QUERIES = int(os.getenv("WARMUP_QUERIES", "8"))
+
+# Cache local de respuestas por Idempotency-Key (por proceso; Cassandra sigue siendo la fuente de verdad)
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_CACHE_TTL = float(os.getenv("IDEMPOTENCY_CACHE_TTL", "300"))
+IDEMPOTENCY_CACHE = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_CACHE_TTL)
+
+# Metadata constante de los depósitos: se serializa una sola vez
+DEPOSIT_METADATA_JSON = orjson.dumps({"description": "Depósito en BDI"}).decode()
+
+# Bancos externos a los que se puede transferir (en mayúsculas)
+_SUPPORTED_BANKS = frozenset({"HAPPY_MONEY"})
 
 # Configura logger (si no se hizo arriba)
 if 'logger' not in locals():
@@ -48,26 +82,145 @@ if 'logger' not in locals():
 app = FastAPI(
     title="Ledger Service - Pixel Money",
     description="Registra todas las transacciones financieras (depósitos, transferencias, aportes) en Cassandra.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse # Serialización de respuestas con orjson (más rápida que json.dumps)
 )
 db_session: Optional[Session] = None
+# Cliente HTTP compartido (pool de conexiones keep-alive hacia los servicios internos)
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+# Cola de escrituras diferidas (ver ledger_writer) y su tarea consumidora
+LEDGER_WRITE_QUEUE: asyncio.Queue = asyncio.Queue()
+_writer_task: Optional[asyncio.Task] = None
+# Sentencias CQL preparadas una sola vez al inicio (se rellenan en startup_event)
+PREPARED = {}
+
+# Proyección explícita con los campos de schemas.Transaction (evita traer columnas que no se devuelven)
+TRANSACTION_COLUMNS = "id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata"
+
+def prepare_statements(session: Session):
+    """Prepara las sentencias CQL reutilizadas por los endpoints."""
+    PREPARED["health"] = session.prepare("SELECT now() FROM system.local")
+    PREPARED["select_idem"] = session.prepare(
+        "SELECT transaction_id FROM idempotency_keys WHERE key = ?")
+    PREPARED["insert_idem"] = session.prepare(
+        "INSERT INTO idempotency_keys (key, transaction_id) VALUES (?, ?)")
+    PREPARED["select_tx"] = session.prepare(
+        f"SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE id = ?")
+    # Depósito (EXTERNAL -> BDI)
+    PREPARED["insert_deposit_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'EXTERNAL', 'N/A', 'BDI', ?, 'DEPOSIT', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_deposit_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'EXTERNAL', 'N/A', 'BDI', ?, 'DEPOSIT', ?, ?, ?, ?, ?)")
+    # Transferencia (BDI -> EXTERNAL_BANK)
+    PREPARED["insert_transfer_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'BDI', ?, 'EXTERNAL_BANK', ?, 'TRANSFER', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_transfer_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'BDI', ?, 'EXTERNAL_BANK', ?, 'TRANSFER', ?, ?, ?, ?, ?)")
+    # Aporte a grupo (BDI -> BDG)
+    PREPARED["insert_contribution_sent_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'BDI', ?, 'BDG', ?, 'CONTRIBUTION_SENT', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_contribution_sent_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'BDI', ?, 'BDG', ?, 'CONTRIBUTION_SENT', ?, ?, ?, ?, ?)")
+    PREPARED["insert_contribution_received_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'BDI', ?, 'BDG', ?, 'CONTRIBUTION_RECEIVED', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_contribution_received_by_group"] = session.prepare(
+        "INSERT INTO transactions_by_group (group_id, created_at, id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, ?, 'BDI', ?, 'BDG', ?, 'CONTRIBUTION_RECEIVED', ?, ?, ?, ?, ?)")
+    # P2P (BDI -> BDI)
+    PREPARED["insert_p2p_sent_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at) VALUES (?, ?, 'BDI', ?, 'BDI', ?, 'P2P_SENT', ?, ?, 'COMPLETED', ?, ?)")
+    PREPARED["insert_p2p_sent_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at) VALUES (?, ?, ?, 'BDI', ?, 'BDI', ?, 'P2P_SENT', ?, ?, 'COMPLETED', ?)")
+    PREPARED["insert_p2p_received_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at) VALUES (?, ?, 'BDI', ?, 'BDI', ?, 'P2P_RECEIVED', ?, ?, 'COMPLETED', ?, ?)")
+    PREPARED["insert_p2p_received_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at) VALUES (?, ?, ?, 'BDI', ?, 'BDI', ?, 'P2P_RECEIVED', ?, ?, 'COMPLETED', ?)")
+    # Transferencia entrante (EXTERNAL_BANK -> BDI)
+    PREPARED["insert_inbound_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'EXTERNAL_BANK', ?, 'BDI', ?, 'DEPOSIT', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_inbound_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'EXTERNAL_BANK', ?, 'BDI', ?, 'DEPOSIT', ?, ?, ?, ?, ?)")
+    # Retiro de grupo (BDG -> BDI)
+    PREPARED["insert_withdrawal_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'BDG', ?, 'BDI', ?, 'GROUP_WITHDRAWAL', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_withdrawal_by_group"] = session.prepare(
+        "INSERT INTO transactions_by_group (group_id, created_at, id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, ?, 'BDG', ?, 'BDI', ?, 'GROUP_WITHDRAWAL', ?, ?, ?, ?, ?)")
+    PREPARED["insert_withdrawal_credit_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'BDG', ?, 'BDI', ?, 'DEPOSIT', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_withdrawal_credit_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'BDG', ?, 'BDI', ?, 'DEPOSIT', ?, ?, ?, ?, ?)")
+    # Préstamos (PIXEL_BANK <-> BDI)
+    PREPARED["insert_loan_disbursement_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'PIXEL_BANK', 'MAIN_VAULT', 'BDI', ?, 'LOAN_DISBURSEMENT', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_loan_disbursement_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'PIXEL_BANK', 'MAIN_VAULT', 'BDI', ?, 'LOAN_DISBURSEMENT', ?, ?, ?, ?, ?)")
+    PREPARED["insert_loan_payment_tx"] = session.prepare(
+        "INSERT INTO transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (?, ?, 'BDI', ?, 'PIXEL_BANK', 'MAIN_VAULT', 'LOAN_PAYMENT', ?, ?, ?, ?, ?, ?)")
+    PREPARED["insert_loan_payment_by_user"] = session.prepare(
+        "INSERT INTO transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (?, ?, ?, 'BDI', ?, 'PIXEL_BANK', 'MAIN_VAULT', 'LOAN_PAYMENT', ?, ?, ?, ?, ?)")
+    # Lecturas de historial y analítica
+    PREPARED["history_by_user"] = session.prepare(
+        f"SELECT {TRANSACTION_COLUMNS} FROM transactions_by_user WHERE user_id = ? ORDER BY created_at DESC LIMIT 50")
+    PREPARED["history_by_group"] = session.prepare(
+        f"SELECT {TRANSACTION_COLUMNS} FROM transactions_by_group WHERE group_id = ? ORDER BY created_at DESC LIMIT 100")
+    PREPARED["daily_balance"] = session.prepare(
+        "SELECT created_at, type, amount FROM transactions_by_user WHERE user_id = ? AND created_at >= ? ORDER BY created_at ASC")
+    # cql() solo devuelve la primera página: el balance necesita todas las filas del rango
+    PREPARED["daily_balance"].fetch_size = None
+    PREPARED["tx_status"] = session.prepare(
+        "UPDATE transactions SET status = ?, updated_at = ? WHERE id = ?")
+    PREPARED["tx_status_meta"] = session.prepare(
+        "UPDATE transactions SET status = ?, metadata = ?, updated_at = ? WHERE id = ?")
+    PREPARED["tx_by_user_status"] = session.prepare(
+        "UPDATE transactions_by_user SET status = ?, updated_at = ? WHERE user_id = ? AND created_at = ? AND id = ?")
+
+async def warm_up():
+    """Abre conexiones a Cassandra y a los servicios internos antes de recibir tráfico."""
+    if db_session:
+        try:
+            await asyncio.gather(*(cql(db_session, PREPARED["health"]) for _ in range(WARMUP_QUERIES)))
+        except Exception as e:
+            logger.warning(f"Calentamiento de Cassandra incompleto: {e}")
+    for url in (BALANCE_SERVICE_URL, INTERBANK_SERVICE_URL):
+        if not url:
+            continue
+        try:
+            await HTTP_CLIENT.get(f"{url}/health", timeout=2.0)
+        except httpx.HTTPError as e:
+            logger.warning(f"Calentamiento de {url} fallido: {e}")
 
 @app.on_event("startup")
-def startup_event():
-    global db_session
+async def startup_event():
+    global db_session, HTTP_CLIENT, _writer_task
     logger.info("Iniciando Ledger Service...")
+    HTTP_CLIENT = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=httpx.Timeout(15.0, connect=2.0)
+    )
     db_session = cassandra_db.get_cassandra_session()
     if db_session:
         try:
             cassandra_db.create_keyspace_and_tables(db_session)
+            prepare_statements(db_session)
         except Exception as e:
             logger.critical(f"FATAL: Error al configurar schema de Cassandra: {e}. El servicio no funcionará.", exc_info=True)
             db_session = None # Marcamos la sesión como nula
     else:
         logger.critical("FATAL: No se pudo conectar a Cassandra al inicio. El servicio no funcionará.")
+    if db_session:
+        _writer_task = asyncio.create_task(ledger_writer())
+    await warm_up()
 
 @app.on_event("shutdown")
-def shutdown_event():
+async def shutdown_event():
+    if _writer_task:
+        # Damos unos segundos para volcar las escrituras pendientes antes de cerrar la sesión
+        try:
+            await asyncio.wait_for(LEDGER_WRITE_QUEUE.join(), timeout=5.0)
+        except TimeoutError:
+            logger.critical(f"{LEDGER_WRITE_QUEUE.qsize()} escrituras pendientes no se volcaron a Cassandra al apagar.")
+        _writer_task.cancel()
+    if HTTP_CLIENT:
+        await HTTP_CLIENT.aclose()
     if db_session and db_session.cluster:
         db_session.cluster.shutdown()
         logger.info("Conexión a Cassandra cerrada.")
@@ -118,8 +271,23 @@ LEDGER_WITHDRAWALS_TOTAL = Counter(
 )
 # --- Fin del Bloque Corregido ---
 # --- Middleware para Métricas ---
+# Etiqueta fija para rutas inexistentes (evita una serie nueva por cada URL escaneada)
+UNMATCHED_ROUTE = "unmatched"
+# Endpoints de observabilidad que no se auto-instrumentan
+UNINSTRUMENTED_PATHS = frozenset({"/metrics", "/health"})
+# Hijos de las métricas ya resueltos por etiqueta (evita el lookup de .labels() en cada request)
+_LATENCY_CHILDREN = {}
+_COUNT_CHILDREN = {}
+
+def route_label(request: Request) -> str:
+    """Plantilla de la ruta (ej. '/transactions/group/{group_id}') en vez de la URL concreta."""
+    route = request.scope.get("route")
+    return route.path if route is not None else UNMATCHED_ROUTE
+
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
+    if request.url.path in UNINSTRUMENTED_PATHS:
+        return await call_next(request)
     start_time = time.time()
     response = None
     status_code = 500
@@ -134,102 +302,203 @@ async def metrics_middleware(request: Request, call_next):
         return Response("Internal Server Error", status_code=500)
     finally:
         latency = time.time() - start_time
-        endpoint = request.url.path
+        endpoint = route_label(request)
         final_status_code = getattr(response, 'status_code', status_code)
-        REQUEST_LATENCY.labels(endpoint=endpoint).observe(latency)
-        REQUEST_COUNT.labels(method=request.method, endpoint=endpoint, status_code=final_status_code).inc()
+        latency_child = _LATENCY_CHILDREN.get(endpoint)
+        if latency_child is None:
+            latency_child = _LATENCY_CHILDREN[endpoint] = REQUEST_LATENCY.labels(endpoint=endpoint)
+        latency_child.observe(latency)
+        count_key = (request.method, endpoint, final_status_code)
+        count_child = _COUNT_CHILDREN.get(count_key)
+        if count_child is None:
+            count_child = _COUNT_CHILDREN[count_key] = REQUEST_COUNT.labels(method=request.method, endpoint=endpoint, status_code=final_status_code)
+        count_child.inc()
     return response
 
 # --- Funciones de Utilidad ---
-def check_idempotency(session: Session, key: str) -> Optional[uuid.UUID]:
-    if not key:
-        return None
-    try:
-        key_uuid = uuid.UUID(key)
-        query = SimpleStatement(f"SELECT transaction_id FROM {KEYSPACE}.idempotency_keys WHERE key = %s")
-        result = session.execute(query, (key_uuid,)).one()
-        return result.transaction_id if result else None
-    except (ValueError, TypeError):
+# Formato canónico de UUID (8-4-4-4-12 hex). Validar con regex evita pagar la excepción de uuid.UUID() en claves inválidas.
+_UUID_RE = re.compile(r"\A[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z", re.I)
+
+def parse_idempotency_key(key: str) -> uuid.UUID:
+    """Valida la Idempotency-Key y la convierte a UUID una sola vez por request."""
+    if not _UUID_RE.match(key):
         logger.warning(f"Clave de idempotencia inválida recibida: {key}")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Formato de Idempotency-Key inválido (debe ser UUID)")
+    return uuid.UUID(key)
+
+def parsed_idempotency_key(
+    idempotency_key: Optional[str] = Header(None, description="Clave única (UUID v4) para idempotencia")
+) -> uuid.UUID:
+    """Dependencia: exige la cabecera Idempotency-Key y la entrega ya convertida a UUID."""
+    if idempotency_key is None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Cabecera Idempotency-Key es requerida")
+    return parse_idempotency_key(idempotency_key)
+
+def balance_from(response: httpx.Response) -> Optional[Decimal]:
+    """Saldo resultante informado por Balance Service (None si la respuesta no lo trae)."""
+    try:
+        return Decimal(str(orjson.loads(response.content)["balance"]))
+    except (orjson.JSONDecodeError, KeyError, TypeError, ArithmeticError):
+        return None
+
+async def cql(session: Session, statement, params=None) -> list:
+    """Ejecuta una sentencia con execute_async sin bloquear el event loop. Devuelve las filas de la primera página."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _set_result(rows):
+        if not future.done():
+            future.set_result(rows)
+
+    def _set_exception(exc):
+        if not future.done():
+            future.set_exception(exc)
+
+    # Los callbacks del driver corren en su hilo de IO: se devuelven al loop con call_soon_threadsafe
+    session.execute_async(statement, params).add_callbacks(
+        lambda rows: loop.call_soon_threadsafe(_set_result, rows),
+        lambda exc: loop.call_soon_threadsafe(_set_exception, exc),
+    )
+    return await future
+
+def enqueue_write(statement, params=None):
+    """Encola una escritura no crítica (estados de fallo) para el escritor en segundo plano."""
+    LEDGER_WRITE_QUEUE.put_nowait((statement, params))
+
+async def ledger_writer():
+    """Vacía LEDGER_WRITE_QUEUE en BATCH UNLOGGED de hasta WRITE_BATCH_MAX sentencias o cada WRITE_BATCH_DELAY segundos."""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await LEDGER_WRITE_QUEUE.get()]
+        deadline = loop.time() + WRITE_BATCH_DELAY
+        while len(items) < WRITE_BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(LEDGER_WRITE_QUEUE.get(), remaining))
+            except TimeoutError:
+                break
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for statement, params in items:
+            batch.add(statement, params)
+        try:
+            await cql(db_session, batch)
+        except Exception as e:
+            logger.critical(f"¡Fallo al escribir {len(items)} estados de fallo en Cassandra! Requiere reconciliación. Error: {e}", exc_info=True)
+        finally:
+            for _ in items:
+                LEDGER_WRITE_QUEUE.task_done()
+
+async def check_idempotency(session: Session, key_uuid: uuid.UUID) -> Optional[uuid.UUID]:
+    try:
+        rows = await cql(session, PREPARED["select_idem"], (key_uuid,))
+        return rows[0]["transaction_id"] if rows else None # Filas como dict (dict_factory)
     except Exception as e:
-        logger.error(f"Error al verificar idempotencia para key {key}: {e}", exc_info=True)
+        logger.error(f"Error al verificar idempotencia para key {key_uuid}: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error interno al verificar idempotencia")
 
+def error_detail(response: httpx.Response, default: Optional[str] = None) -> Optional[str]:
+    """Extrae el 'detail' de una respuesta de error, parseando el cuerpo una sola vez."""
+    # Cuerpos no-JSON (p.ej. páginas 502 del proxy) se devuelven tal cual sin lanzar excepciones
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        return response.text
+    try:
+        body = orjson.loads(response.content)
+    except orjson.JSONDecodeError: # Content-Type JSON pero cuerpo corrupto
+        return response.text
+    return body.get("detail", default) if isinstance(body, dict) else default
+
+def cache_replay(key_uuid: uuid.UUID, tx_data: dict) -> schemas.Transaction:
+    """Valida la tx original de una réplica y, si ya es definitiva, la cachea para los siguientes reintentos."""
+    tx = schemas.Transaction.model_validate(tx_data)
+    if tx.status == "COMPLETED": # Un PENDING todavía puede cambiar: se vuelve a leer de Cassandra
+        IDEMPOTENCY_CACHE[key_uuid] = tx
+    return tx
+
 async def get_transaction_by_id(session: Session, tx_id: uuid.UUID) -> Optional[dict]:
     try:
-        query = SimpleStatement(f"SELECT * FROM {KEYSPACE}.transactions WHERE id = %s")
-        result = session.execute(query, (tx_id,)).one()
-        return result._asdict() if result else None
+        rows = await cql(session, PREPARED["select_tx"], (tx_id,))
+        result = rows[0] if rows else None
+        return result # La fila ya es un dict (dict_factory): sin copias intermedias
     except Exception as e:
         logger.error(f"Error al obtener transacción {tx_id}: {e}", exc_info=True)
         return None
 
 # --- Endpoints de la API ---
 
-@app.post("/deposit", response_model=schemas.Transaction, status_code=status.HTTP_201_CREATED, tags=["Transactions"])
+@app.post("/deposit", response_model=schemas.TransactionResult, status_code=status.HTTP_201_CREATED, tags=["Transactions"])
 async def deposit(
     req: schemas.DepositRequest,
-    idempotency_key: Optional[str] = Header(None, description="Clave única (UUID v4) para idempotencia"),
+    idempotency_uuid: uuid.UUID = Depends(parsed_idempotency_key),
     db: Session = Depends(get_db)
 ):
-    if idempotency_key is None:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Cabecera Idempotency-Key es requerida")
-
-    existing_tx_id = check_idempotency(db, idempotency_key)
+    cached_tx = IDEMPOTENCY_CACHE.get(idempotency_uuid)
+    if cached_tx is not None: # Réplica reciente: se responde sin tocar Cassandra
+        return cached_tx
+    existing_tx_id = await check_idempotency(db, idempotency_uuid)
     if existing_tx_id:
-        logger.info(f"Depósito duplicado (Key: {idempotency_key}). Devolviendo tx: {existing_tx_id}")
+        logger.info(f"Depósito duplicado (Key: {idempotency_uuid}). Devolviendo tx: {existing_tx_id}")
         tx_data = await get_transaction_by_id(db, existing_tx_id)
-        if tx_data: return schemas.Transaction(**tx_data)
+        if tx_data: return cache_replay(idempotency_uuid, tx_data)
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error de idempotencia: Tx original no encontrada")
 
     tx_id = uuid.uuid4()
     now = datetime.now(timezone.utc)
-    metadata_json = json.dumps({"description": "Depósito en BDI"})
+    metadata_json = DEPOSIT_METADATA_JSON
     status_final = "PENDING"
     currency = "PEN"
+    new_balance = None
 
+    # Intención durable ANTES de mover dinero (como en transfer): si el proceso cae tras el crédito
+    # queda la fila PENDING para reconciliar. La clave de idempotencia NO se graba aquí: solo se
+    # liga a la tx al quedar COMPLETED, así un reintento tras un crédito fallido vuelve a acreditar.
     try:
-        # (El BATCH de PENDING... se queda igual que en el PDF) [cite: 168-187]
-        query_by_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'EXTERNAL', 'N/A', 'BDI', %s, 'DEPOSIT', %s, %s, %s, %s, %s, %s)")
-        query_by_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, 'EXTERNAL', 'N/A', 'BDI', %s, 'DEPOSIT', %s, %s, %s, %s, %s)")
-        batch = BatchStatement()
-        batch.add(query_by_id, (tx_id, req.user_id, str(req.user_id), Decimal(str(req.amount)), currency, status_final, now, now, metadata_json))
-        batch.add(query_by_user, (req.user_id, now, tx_id, str(req.user_id), Decimal(str(req.amount)), currency, status_final, now, metadata_json))
-        db.execute(batch)
+        # UNLOGGED: es una sola intención; el estado final la sobrescribe en ambas tablas
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        batch.add(PREPARED["insert_deposit_tx"], (tx_id, req.user_id, str(req.user_id), req.amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_deposit_by_user"], (req.user_id, now, tx_id, str(req.user_id), req.amount, currency, status_final, now, metadata_json))
+        await cql(db, batch)
     except Exception as e:
         logger.error(f"Error al insertar BATCH PENDING (depósito) {tx_id}: {e}", exc_info=True)
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error al registrar la transacción inicial")
 
+    def status_rows(final_status: str, updated_at: datetime) -> list:
+        """Cierra el estado en ambas tablas: sin esto el historial del usuario se queda en PENDING."""
+        return [
+            (PREPARED["tx_status_meta"], (final_status, metadata_json, updated_at, tx_id)),
+            (PREPARED["tx_by_user_status"], (final_status, updated_at, req.user_id, now, tx_id)),
+        ]
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/credit",
-                json={"user_id": req.user_id, "amount": req.amount}
-            )
-            response.raise_for_status()
+        response = await HTTP_CLIENT.post(
+            URL_CREDIT,
+            json={"user_id": req.user_id, "amount": float(req.amount)}
+        )
+        response.raise_for_status()
         status_final = "COMPLETED"
+        new_balance = balance_from(response)
     except (httpx.RequestError, httpx.HTTPStatusError) as e:
         # (La lógica de error de depósito... se queda igual que en el PDF) [cite: 199-212]
         status_final = "FAILED_BALANCE_SVC"
         detail = f"Balance Service falló al acreditar: {e}"
         status_code = status.HTTP_503_SERVICE_UNAVAILABLE
         if isinstance(e, httpx.HTTPStatusError):
-            try: 
-                detail = e.response.json().get("detail", str(e))
-            except json.JSONDecodeError: 
-                detail = e.response.text
+            detail = error_detail(e.response, str(e))
             status_code = e.response.status_code
         logger.error(f"Fallo en tx {tx_id} (depósito): {detail}")
-        db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, updated_at = %s WHERE id = %s", (status_final, datetime.now(timezone.utc), tx_id))
-        db.execute(f"UPDATE {KEYSPACE}.transactions_by_user SET status = %s, updated_at = %s WHERE user_id = %s AND created_at = %s AND id = %s", (status_final, datetime.now(timezone.utc), req.user_id, now, tx_id)) # ¡Fix! Añadido update a transactions_by_user
+        for statement, params in status_rows(status_final, datetime.now(timezone.utc)):
+            enqueue_write(statement, params)
         raise HTTPException(status_code=status_code, detail=detail)
 
+    finished_at = datetime.now(timezone.utc) # Un solo timestamp de cierre para la fila y la respuesta
     try:
-        idempotency_uuid = uuid.UUID(idempotency_key)
-        db.execute(f"INSERT INTO {KEYSPACE}.idempotency_keys (key, transaction_id) VALUES (%s, %s)", (idempotency_uuid, tx_id))
-        db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, updated_at = %s WHERE id = %s", (status_final, datetime.now(timezone.utc), tx_id))
-        db.execute(f"UPDATE {KEYSPACE}.transactions_by_user SET status = %s, updated_at = %s WHERE user_id = %s AND created_at = %s AND id = %s", (status_final, datetime.now(timezone.utc), req.user_id, now, tx_id)) # ¡Fix! Añadido update
+        # Un único BATCH LOGGED: estado COMPLETED + clave de idempotencia en un solo round-trip
+        batch = BatchStatement() # LOGGED por defecto: todas las filas o ninguna
+        for statement, params in status_rows(status_final, finished_at):
+            batch.add(statement, params)
+        batch.add(PREPARED["insert_idem"], (idempotency_uuid, tx_id))
+        await cql(db, batch)
 
         DEPOSIT_COUNT.inc() # <-- ¡MÉTRICA CORREGIDA!
 
@@ -237,173 +506,230 @@ async def deposit(
     except Exception as final_e:
         # (Lógica de PENDING_CONFIRMATION... se queda igual que en el PDF) [cite: 220-224]
         status_final = "PENDING_CONFIRMATION"
-        db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, updated_at = %s WHERE id = %s", (status_final, datetime.now(timezone.utc), tx_id))
-        db.execute(f"UPDATE {KEYSPACE}.transactions_by_user SET status = %s, updated_at = %s WHERE user_id = %s AND created_at = %s AND id = %s", (status_final, datetime.now(timezone.utc), req.user_id, now, tx_id)) # ¡Fix! Añadido update
+        for statement, params in status_rows(status_final, finished_at):
+            enqueue_write(statement, params)
         logger.critical(f"¡FALLO CRÍTICO post-crédito en tx {tx_id}! Estado: {status_final}. Error: {final_e}. Requiere reconciliación manual.")
 
-    tx_data = await get_transaction_by_id(db, tx_id)
-    if not tx_data: raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "No se pudo recuperar la transacción final")
-    return schemas.Transaction(**tx_data)
-
-@app.post("/transfer", response_model=schemas.Transaction, status_code=status.HTTP_201_CREATED, tags=["Transactions"])
+    # Construimos la respuesta con los datos que ya tenemos (evita un SELECT extra a Cassandra)
+    tx = schemas.Transaction.model_construct(
+        id=tx_id, user_id=req.user_id,
+        source_wallet_type="EXTERNAL", source_wallet_id="N/A",
+        destination_wallet_type="BDI", destination_wallet_id=str(req.user_id),
+        type="DEPOSIT", amount=req.amount, currency=currency, status=status_final,
+        created_at=now, updated_at=finished_at, metadata=metadata_json
+    )
+    if status_final == "COMPLETED": # Solo entonces se grabó la clave de idempotencia
+        IDEMPOTENCY_CACHE[idempotency_uuid] = tx
+    # El saldo resultante solo se informa en la respuesta original (no se cachea para réplicas)
+    return schemas.TransactionResult.model_construct(**tx.__dict__, new_balance=new_balance)
+
+@app.post("/transfer", response_model=schemas.TransactionResult, status_code=status.HTTP_201_CREATED, tags=["Transactions"])
 async def transfer(
     req: schemas.TransferRequest, 
-    idempotency_key: Optional[str] = Header(None, description="Clave única (UUID v4) para idempotencia"),
+    idempotency_uuid: uuid.UUID = Depends(parsed_idempotency_key),
     db: Session = Depends(get_db)
 ):
     """Procesa una transferencia BDI -> BDI (Externa a Happy Money)."""
-    if idempotency_key is None:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Cabecera Idempotency-Key es requerida")
-    if req.to_bank.upper() != "HAPPY_MONEY":
+    to_bank = req.to_bank.upper()
+    if to_bank not in _SUPPORTED_BANKS:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Banco de destino '{req.to_bank}' no soportado")
 
-    existing_tx_id = check_idempotency(db, idempotency_key)
+    cached_tx = IDEMPOTENCY_CACHE.get(idempotency_uuid)
+    if cached_tx is not None: # Réplica reciente: se responde sin tocar Cassandra
+        return cached_tx
+    existing_tx_id = await check_idempotency(db, idempotency_uuid)
     if existing_tx_id:
-        logger.info(f"Transferencia duplicada detectada (Key: {idempotency_key}). Devolviendo tx: {existing_tx_id}")
+        logger.info(f"Transferencia duplicada detectada (Key: {idempotency_uuid}). Devolviendo tx: {existing_tx_id}")
         tx_data = await get_transaction_by_id(db, existing_tx_id)
-        if tx_data: return schemas.Transaction(**tx_data)
-        logger.error(f"INCONSISTENCIA: Key {idempotency_key} existe pero tx_id {existing_tx_id} no encontrado.")
+        if tx_data: return cache_replay(idempotency_uuid, tx_data)
+        logger.error(f"INCONSISTENCIA: Key {idempotency_uuid} existe pero tx_id {existing_tx_id} no encontrado.")
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error de idempotencia: Transacción original no encontrada")
 
     tx_id = uuid.uuid4()
     now = datetime.now(timezone.utc)
     
     metadata = {"to_bank": req.to_bank, "destination_phone_number": req.destination_phone_number}
+    metadata_json = orjson.dumps(metadata).decode() # Se re-serializa solo cuando 'metadata' cambia
     status_final = "PENDING"
     currency = "PEN"
 
         # En la función transfer(), reemplaza el primer 'try...'
     try:
-        query_by_id = SimpleStatement(f"""
-            INSERT INTO {KEYSPACE}.transactions (
-                id, user_id, source_wallet_type, source_wallet_id,
-                destination_wallet_type, destination_wallet_id, type, amount, currency,
-                status, created_at, updated_at, metadata
-            ) VALUES (%s, %s, 'BDI', %s, 'EXTERNAL_BANK', %s, 'TRANSFER', %s, %s, %s, %s, %s, %s)
-        """)
-
-        query_by_user = SimpleStatement(f"""
-            INSERT INTO {KEYSPACE}.transactions_by_user (
-                user_id, created_at, id, source_wallet_type, source_wallet_id,
-                destination_wallet_type, destination_wallet_id, type, amount, currency,
-                status, updated_at, metadata
-            ) VALUES (%s, %s, %s, 'BDI', %s, 'EXTERNAL_BANK', %s, 'TRANSFER', %s, %s, %s, %s, %s)
-        """)
-
         batch = BatchStatement()
-        batch.add(query_by_id, (tx_id, req.user_id, str(req.user_id), req.destination_phone_number, req.amount, currency, status_final, now, now, json.dumps(metadata)))
-        batch.add(query_by_user, (req.user_id, now, tx_id, str(req.user_id), req.destination_phone_number, req.amount, currency, status_final, now, json.dumps(metadata)))
+        batch.add(PREPARED["insert_transfer_tx"], (tx_id, req.user_id, str(req.user_id), req.destination_phone_number, req.amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_transfer_by_user"], (req.user_id, now, tx_id, str(req.user_id), req.destination_phone_number, req.amount, currency, status_final, now, metadata_json))
 
-        db.execute(batch)
+        await cql(db, batch)
 
     except Exception as e:
         logger.error(f"Error al insertar BATCH PENDING (transfer) {tx_id}: {e}", exc_info=True)
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error al registrar la transacción inicial")
 
+    def status_rows(final_status: str, updated_at: datetime) -> list:
+        """Cierra el estado en ambas tablas: sin esto el historial del usuario se queda en PENDING."""
+        return [
+            (PREPARED["tx_status_meta"], (final_status, metadata_json, updated_at, tx_id)),
+            (PREPARED["tx_by_user_status"], (final_status, updated_at, req.user_id, now, tx_id)),
+        ]
+
+    # Paso de la saga alcanzado: decide si hay que devolver el débito al fallar
+    saga_state = "NOT_STARTED"
+    new_balance = None
+    # Mismo cuerpo para el débito y su eventual devolución: se serializa una sola vez
+    balance_body = orjson.dumps({"user_id": req.user_id, "amount": float(req.amount)})
+
+    async def refund_debit():
+        """Compensa el débito ya aplicado cuando el banco externo no aceptó la transferencia."""
+        try:
+            refund_res = await HTTP_CLIENT.post(
+                URL_CREDIT,
+                content=balance_body,
+                headers=JSON_HEADERS
+            )
+            refund_res.raise_for_status()
+            logger.info(f"Débito de tx {tx_id} devuelto a user_id {req.user_id}.")
+        except Exception as refund_error:
+            logger.critical(f"¡¡FALLO CRÍTICO DE REVERSIÓN!! El débito de tx {tx_id} no pudo ser devuelto. ¡REQUERIRÁ INTERVENCIÓN MANUAL! Error: {refund_error}")
+
+    def uncertain_status(failure_status: str, cause: str) -> str:
+        """
+        Estado final tras un fallo ambiguo (timeout, error de lectura, error inesperado).
+        Si el débito pudo aplicarse o el dinero ya salió, no se marca como fallido: queda
+        PENDING_CONFIRMATION para reconciliación.
+        """
+        if saga_state in ("DEBIT_IN_FLIGHT", "DEBITED", "COMPLETED"):
+            logger.critical(f"¡{cause} en tx {tx_id} con {saga_state}! Estado del dinero desconocido. Requiere reconciliación.")
+            return "PENDING_CONFIRMATION"
+        return failure_status
+
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            # 1. Verificar Fondos en BDI origen
-            logger.debug(f"Tx {tx_id}: Verificando fondos para user_id {req.user_id}")
-            check_res = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/check",
-                json={"user_id": req.user_id, "amount": req.amount}
+        # Deadline global: acota la latencia total aunque cada llamada tenga su propio timeout
+        async with asyncio.timeout(EXTERNAL_CALLS_DEADLINE):
+            # 1. Debitar Saldo en BDI origen (el débito ya verifica fondos: sin /balance/check previo)
+            logger.debug(f"Tx {tx_id}: Debitando saldo de user_id {req.user_id}")
+            saga_state = "DEBIT_IN_FLIGHT"
+            debit_res = await HTTP_CLIENT.post(
+                URL_DEBIT,
+                content=balance_body,
+                headers=JSON_HEADERS
             )
-            # ¡Si esto falla (400), saltará al 'except HTTPStatusError'
-            check_res.raise_for_status() 
-            logger.debug(f"Tx {tx_id}: Fondos verificados.")
+            # ¡Si esto falla (400), saltará al 'except HTTPStatusError' sin nada que revertir
+            debit_res.raise_for_status()
+            saga_state = "DEBITED"
+            new_balance = balance_from(debit_res)
 
             # 2. Llamar al Servicio Interbancario (Happy Money)
             logger.debug(f"Tx {tx_id}: Llamando a Interbank Service...")
             interbank_payload = {
                 "origin_bank": "PIXEL_MONEY",
                 "origin_account_id": str(req.user_id),
-                "destination_bank": req.to_bank.upper(),
+                "destination_bank": to_bank,
                 "destination_phone_number": req.destination_phone_number,
-                "amount": req.amount,
+                "amount": float(req.amount),
                 "currency": currency,
                 "transaction_id": str(tx_id),
                 "description": "Transferencia desde Pixel Money"
             }
-            interbank_headers = {"X-API-KEY": INTERBANK_API_KEY}
 
-            response_bank_b = await client.post(
-                f"{INTERBANK_SERVICE_URL}/interbank/transfers",
-                json=interbank_payload,
-                headers=interbank_headers
+            # Cuerpo pre-serializado con orjson (evita el json.dumps interno de httpx)
+            response_bank_b = await HTTP_CLIENT.post(
+                INTERBANK_URL,
+                content=orjson.dumps(interbank_payload),
+                headers=INTERBANK_HEADERS
             )
 
-            # ¡Si el banco externo falla, raise_for_status() también saltará!
-            response_bank_b.raise_for_status() 
+            # ¡Si el banco externo falla, raise_for_status() también saltará (y se devuelve el débito)!
+            response_bank_b.raise_for_status()
+            saga_state = "COMPLETED"
 
-            bank_b_response = response_bank_b.json()
+            bank_b_response = orjson.loads(response_bank_b.content)
             remote_tx_id = bank_b_response.get("remote_transaction_id")
             metadata["remote_tx_id"] = remote_tx_id
+            metadata_json = orjson.dumps(metadata).decode()
             logger.info(f"Banco externo aceptó tx {tx_id}. ID remoto: {remote_tx_id}")
 
-            # 3. Debitar Saldo en BDI origen (Paso final)
-            logger.debug(f"Tx {tx_id}: Debitando saldo de user_id {req.user_id}")
-            debit_res = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/debit",
-                json={"user_id": req.user_id, "amount": req.amount}
-            )
-            debit_res.raise_for_status() # Si el débito falla, saltará
-
-            # 4. Todo OK
+            # 3. Todo OK
             status_final = "COMPLETED"
 
     # --- INICIO DEL BLOQUE CORREGIDO ---
     except httpx.HTTPStatusError as e:
         
         status_code = e.response.status_code
-        try:
-            detail = e.response.json().get("detail", "Error desconocido del servicio interno.")
-        except json.JSONDecodeError:
-            detail = e.response.text
+        detail = error_detail(e.response, "Error desconocido del servicio interno.")
 
         if status_code == 400: status_final = "FAILED_FUNDS" # Asumimos que 400 es Fondos Insuficientes
         elif status_code == 404: status_final = "FAILED_ACCOUNT"
         else: status_final = f"FAILED_HTTP_{status_code}" # Otro error (ej. 401 de API Key)
 
         logger.warning(f"Transferencia {status_final} para tx {tx_id}: {detail}")
-        db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, metadata = %s, updated_at = %s WHERE id = %s",
-                (status_final, json.dumps(metadata), datetime.now(timezone.utc), tx_id))
+        if saga_state == "DEBITED": # Rechazo del banco externo
+            await refund_debit()
+        for statement, params in status_rows(status_final, datetime.now(timezone.utc)):
+            enqueue_write(statement, params)
         # Re-lanzamos la excepción para que el cliente reciba el código y detalle correctos
         raise HTTPException(status_code=status_code, detail=detail)
 
+    except TimeoutError: # Se agotó el deadline global de llamadas externas
+        logger.error(f"Deadline de {EXTERNAL_CALLS_DEADLINE}s agotado en tx {tx_id} (transferencia, {saga_state})")
+        status_final = uncertain_status("FAILED_NETWORK", "Deadline agotado")
+        for statement, params in status_rows(status_final, datetime.now(timezone.utc)):
+            enqueue_write(statement, params)
+        raise HTTPException(status.HTTP_504_GATEWAY_TIMEOUT, "Tiempo de espera agotado al contactar servicios externos")
+
     except httpx.RequestError as e: # Error de Red (timeout, servicio caído)
-        status_final = "FAILED_NETWORK"
-        db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, metadata = %s, updated_at = %s WHERE id = %s",
-                (status_final, json.dumps(metadata), datetime.now(timezone.utc), tx_id))
         logger.error(f"Fallo de red en tx {tx_id} (transferencia): {e}", exc_info=True)
+        if isinstance(e, httpx.ConnectError):
+            # La petición nunca salió: el débito en vuelo no se aplicó y uno ya aplicado se devuelve
+            status_final = "FAILED_NETWORK"
+            if saga_state == "DEBITED":
+                await refund_debit()
+        else:
+            status_final = uncertain_status("FAILED_NETWORK", "Fallo de red")
+        for statement, params in status_rows(status_final, datetime.now(timezone.utc)):
+            enqueue_write(statement, params)
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, f"Error de red al contactar servicios: {e}")
 
     except Exception as e: # Bug nuestro
-        status_final = "FAILED_UNKNOWN"
-        db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, metadata = %s, updated_at = %s WHERE id = %s",
-                (status_final, json.dumps(metadata), datetime.now(timezone.utc), tx_id))
         logger.error(f"Error inesperado en tx {tx_id} (transferencia): {e}", exc_info=True)
+        if saga_state == "DEBITED": # Débito confirmado pero la transferencia no se completó: se devuelve
+            status_final = "FAILED_UNKNOWN"
+            await refund_debit()
+        else:
+            status_final = uncertain_status("FAILED_UNKNOWN", "Error inesperado")
+        for statement, params in status_rows(status_final, datetime.now(timezone.utc)):
+            enqueue_write(statement, params)
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error interno inesperado procesando la transferencia")
     
 
     # Si todo fue exitoso
+    finished_at = datetime.now(timezone.utc) # Un solo timestamp de cierre para la fila y la respuesta
     if status_final == "COMPLETED":
         try:
-            idempotency_uuid = uuid.UUID(idempotency_key)
-            db.execute(f"INSERT INTO {KEYSPACE}.idempotency_keys (key, transaction_id) VALUES (%s, %s)",
-                       (idempotency_uuid, tx_id))
-            db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, metadata = %s, updated_at = %s WHERE id = %s",
-                       (status_final, json.dumps(metadata), datetime.now(timezone.utc), tx_id))
+            # Estado final + clave de idempotencia en un único BATCH LOGGED (un solo round-trip)
+            batch = BatchStatement()
+            for statement, params in status_rows(status_final, finished_at):
+                batch.add(statement, params)
+            batch.add(PREPARED["insert_idem"], (idempotency_uuid, tx_id))
+            await cql(db, batch)
             LEDGER_P2P_TRANSFERS_TOTAL.inc() # Incrementamos métrica
             logger.info(f"Transferencia {status_final} para user_id {req.user_id}, tx_id {tx_id}")
         except Exception as final_e:
              status_final = "PENDING_CONFIRMATION"
-             db.execute(f"UPDATE {KEYSPACE}.transactions SET status = %s, metadata = %s, updated_at = %s WHERE id = %s",
-                   (status_final, json.dumps(metadata), datetime.now(timezone.utc), tx_id))
+             for statement, params in status_rows(status_final, finished_at):
+                 enqueue_write(statement, params)
              logger.critical(f"¡FALLO CRÍTICO post-débito en tx {tx_id}! Estado: {status_final}. Error: {final_e}. Requiere reconciliación.")
 
-    tx_data = await get_transaction_by_id(db, tx_id)
-    if not tx_data: raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "No se pudo recuperar la transacción final")
-    return schemas.Transaction(**tx_data)
+    # Construimos la respuesta con los datos que ya tenemos (evita un SELECT extra a Cassandra)
+    tx = schemas.Transaction.model_construct(
+        id=tx_id, user_id=req.user_id,
+        source_wallet_type="BDI", source_wallet_id=str(req.user_id),
+        destination_wallet_type="EXTERNAL_BANK", destination_wallet_id=req.destination_phone_number,
+        type="TRANSFER", amount=req.amount, currency=currency, status=status_final,
+        created_at=now, updated_at=finished_at, metadata=metadata_json
+    )
+    if status_final == "COMPLETED": # Solo entonces se grabó la clave de idempotencia
+        IDEMPOTENCY_CACHE[idempotency_uuid] = tx
+    return schemas.TransactionResult.model_construct(**tx.__dict__, new_balance=new_balance)
 
 
 # REEMPLAZA la función 'contribute_to_group' entera con esto:
@@ -411,25 +737,26 @@ async def transfer(
 @app.post("/contribute", response_model=schemas.Transaction, status_code=status.HTTP_201_CREATED, tags=["Transactions"])
 async def contribute_to_group(
     req: schemas.ContributionRequest,
-    idempotency_key: Optional[str] = Header(None, description="Clave única (UUID v4) para idempotencia"),
+    idempotency_uuid: uuid.UUID = Depends(parsed_idempotency_key),
     db: Session = Depends(get_db)
 ):
     """
     Procesa un aporte desde una BDI (individual) a una BDG (grupal).
     Crea 2 transacciones: SENT (para el usuario) y RECEIVED (para el grupo).
     """
-    if idempotency_key is None:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Cabecera Idempotency-Key es requerida")
 
     sender_id = req.user_id
     group_id = req.group_id
     amount = req.amount
 
-    existing_tx_id = check_idempotency(db, idempotency_key)
+    cached_tx = IDEMPOTENCY_CACHE.get(idempotency_uuid)
+    if cached_tx is not None: # Réplica reciente: se responde sin tocar Cassandra
+        return cached_tx
+    existing_tx_id = await check_idempotency(db, idempotency_uuid)
     if existing_tx_id:
-        logger.info(f"Aporte duplicado (Key: {idempotency_key}). Devolviendo tx: {existing_tx_id}")
+        logger.info(f"Aporte duplicado (Key: {idempotency_uuid}). Devolviendo tx: {existing_tx_id}")
         tx_data = await get_transaction_by_id(db, existing_tx_id)
-        if tx_data: return schemas.Transaction(**tx_data)
+        if tx_data: return cache_replay(idempotency_uuid, tx_data)
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error de idempotencia: Tx original no encontrada")
 
     tx_id_sent = uuid.uuid4()
@@ -437,82 +764,100 @@ async def contribute_to_group(
     now = datetime.now(timezone.utc)
     currency = "PEN"
     metadata = {"contribution_to_group_id": group_id}
-    metadata_json = json.dumps(metadata)
+    metadata_json = orjson.dumps(metadata).decode()
+    # Paso de la saga alcanzado: decide qué hacer si se agota el deadline
+    saga_state = "NOT_STARTED"
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-
-            # 1. Debitar BDI origen (¡Verifica y resta!)
-            logger.debug(f"Tx {tx_id_sent}: Debitando BDI para user_id {sender_id}")
-            debit_res = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/debit",
-                json={"user_id": sender_id, "amount": amount}
+        # Deadline global: acota la latencia total aunque cada llamada tenga su propio timeout
+        async with asyncio.timeout(EXTERNAL_CALLS_DEADLINE):
+
+            # 1. Debitar BDI y acreditar BDG en una sola transacción de Balance Service
+            logger.debug(f"Tx {tx_id_sent}: Transfiriendo de BDI {sender_id} a BDG {group_id}")
+            saga_state = "DEBIT_IN_FLIGHT"
+            transfer_res = await HTTP_CLIENT.post(
+                URL_TRANSFER_TO_GROUP,
+                json={"user_id": sender_id, "group_id": group_id, "amount": float(amount)}
             )
-            debit_res.raise_for_status() # Falla aquí si hay 'Insufficient funds' (400)
+            transfer_res.raise_for_status() # Falla aquí si hay 'Insufficient funds' (400)
+            saga_state = "DEBITED"
 
-            # 2. Acreditar BDG destino
+            # 2. Actualizar Saldo Interno
             try:
-                logger.debug(f"Tx {tx_id_received}: Acreditando BDG para group_id {group_id}")
-                credit_res = await client.post(
-                    f"{BALANCE_SERVICE_URL}/group_balance/credit",
-                    json={"group_id": group_id, "amount": amount}
-                )
-                credit_res.raise_for_status() 
-
-                # 3. Actualizar Saldo Interno
                 logger.debug(f"Tx {tx_id_received}: Actualizando internal_balance para user {sender_id}")
-                internal_res = await client.post(
+                internal_res = await HTTP_CLIENT.post(
                     f"{GROUP_SERVICE_URL}/groups/{group_id}/member_balance",
-                    json={"user_id_to_update": sender_id, "amount": amount} # ¡Es un Aporte (positivo)!
+                    json={"user_id_to_update": sender_id, "amount": float(amount)} # ¡Es un Aporte (positivo)!
                 )
                 internal_res.raise_for_status()
 
             except Exception as credit_error:
-                # ¡FALLO DE SAGA! Revertir el débito
-                logger.error(f"¡FALLO DE SAGA! Crédito al grupo {group_id} falló. Revertiendo débito {tx_id_sent}...")
-                async with httpx.AsyncClient() as revert_client:
-                    revert_res = await revert_client.post(
-                        f"{BALANCE_SERVICE_URL}/balance/credit", # ¡Revertimos con un CRÉDITO!
-                        json={"user_id": sender_id, "amount": amount}
-                    )
-                    revert_res.raise_for_status()
-                logger.info(f"Reversión de débito BDI para tx {tx_id_sent} exitosa.")
+                # ¡FALLO DE SAGA! Revertir la transferencia completa (BDG -> BDI)
+                logger.error(f"¡FALLO DE SAGA! Saldo interno del grupo {group_id} no actualizado. Revirtiendo transferencia {tx_id_sent}...")
+                saga_state = "REVERT_IN_FLIGHT"
+                revert_res = await HTTP_CLIENT.post(
+                    URL_TRANSFER_FROM_GROUP,
+                    json={"user_id": sender_id, "group_id": group_id, "amount": float(amount)}
+                )
+                revert_res.raise_for_status()
+                logger.info(f"Reversión de transferencia BDI->BDG para tx {tx_id_sent} exitosa.")
 
                 if isinstance(credit_error, httpx.HTTPStatusError):
-                    raise HTTPException(status_code=credit_error.response.status_code, detail=f"Error al acreditar al grupo: {credit_error.response.json().get('detail')}")
+                    raise HTTPException(status_code=credit_error.response.status_code, detail=f"Error al acreditar al grupo: {error_detail(credit_error.response)}")
                 else:
                     raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error interno al acreditar al grupo.")
 
         # 4. ¡ÉXITO! Escribir ambas transacciones en Cassandra
         status_final = "COMPLETED"
-        decimal_amount = Decimal(str(amount))
 
         batch = BatchStatement()
 
         # Tx de SALIDA (para el historial del USUARIO)
-        q_sent_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'BDI', %s, 'BDG', %s, 'CONTRIBUTION_SENT', %s, %s, %s, %s, %s, %s)")
-        q_sent_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, 'BDI', %s, 'BDG', %s, 'CONTRIBUTION_SENT', %s, %s, %s, %s, %s)")
-        batch.add(q_sent_id, (tx_id_sent, sender_id, str(sender_id), str(group_id), decimal_amount, currency, status_final, now, now, metadata_json))
-        batch.add(q_sent_user, (sender_id, now, tx_id_sent, str(sender_id), str(group_id), decimal_amount, currency, status_final, now, metadata_json))
+        batch.add(PREPARED["insert_contribution_sent_tx"], (tx_id_sent, sender_id, str(sender_id), str(group_id), amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_contribution_sent_by_user"], (sender_id, now, tx_id_sent, str(sender_id), str(group_id), amount, currency, status_final, now, metadata_json))
 
         # Tx de ENTRADA (para el historial del GRUPO)
-        q_received_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'BDI', %s, 'BDG', %s, 'CONTRIBUTION_RECEIVED', %s, %s, %s, %s, %s, %s)")
-        q_received_group = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_group (group_id, created_at, id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, %s, 'BDI', %s, 'BDG', %s, 'CONTRIBUTION_RECEIVED', %s, %s, %s, %s, %s)")
-        batch.add(q_received_id, (tx_id_received, sender_id, str(sender_id), str(group_id), decimal_amount, currency, status_final, now, now, metadata_json))
-        batch.add(q_received_group, (group_id, now, tx_id_received, sender_id, str(sender_id), str(group_id), decimal_amount, currency, status_final, now, metadata_json))
+        batch.add(PREPARED["insert_contribution_received_tx"], (tx_id_received, sender_id, str(sender_id), str(group_id), amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_contribution_received_by_group"], (group_id, now, tx_id_received, sender_id, str(sender_id), str(group_id), amount, currency, status_final, now, metadata_json))
 
-        db.execute(batch)
-        db.execute(f"INSERT INTO {KEYSPACE}.idempotency_keys (key, transaction_id) VALUES (%s, %s)", (uuid.UUID(idempotency_key), tx_id_sent))
+        # La clave de idempotencia viaja en el mismo BATCH LOGGED
+        batch.add(PREPARED["insert_idem"], (idempotency_uuid, tx_id_sent))
+        await cql(db, batch)
 
         CONTRIBUTION_COUNT.inc() # <-- ¡MÉTRICA CORREGIDA!
 
-        tx_data = await get_transaction_by_id(db, tx_id_sent)
-        if not tx_data: raise Exception("No se pudo recuperar la transacción final")
-        return schemas.Transaction(**tx_data)
+        # Devolvemos la tx de SALIDA construida en memoria (sin releerla de Cassandra)
+        tx = schemas.Transaction.model_construct(
+            id=tx_id_sent, user_id=sender_id,
+            source_wallet_type="BDI", source_wallet_id=str(sender_id),
+            destination_wallet_type="BDG", destination_wallet_id=str(group_id),
+            type="CONTRIBUTION_SENT", amount=amount, currency=currency, status=status_final,
+            created_at=now, updated_at=now, metadata=metadata_json
+        )
+        IDEMPOTENCY_CACHE[idempotency_uuid] = tx
+        return tx
+
+    except TimeoutError: # Se agotó el deadline global de llamadas externas
+        logger.error(f"Deadline de {EXTERNAL_CALLS_DEADLINE}s agotado en tx {tx_id_sent} (aporte)")
+        if saga_state in ("DEBIT_IN_FLIGHT", "REVERT_IN_FLIGHT"):
+            # No sabemos si Balance Service aplicó la operación en curso
+            logger.critical(f"¡Deadline agotado con {saga_state} en tx {tx_id_sent}! Estado del débito desconocido. ¡REQUERIRÁ INTERVENCIÓN MANUAL!")
+        elif saga_state == "DEBITED":
+            # La transferencia ya se aplicó: la revertimos fuera del deadline
+            try:
+                revert_res = await HTTP_CLIENT.post(
+                    URL_TRANSFER_FROM_GROUP,
+                    json={"user_id": sender_id, "group_id": group_id, "amount": float(amount)}
+                )
+                revert_res.raise_for_status()
+                logger.info(f"Reversión de transferencia BDI->BDG para tx {tx_id_sent} exitosa.")
+            except Exception as revert_error:
+                logger.critical(f"¡¡FALLO CRÍTICO DE REVERSIÓN!! El débito {tx_id_sent} no pudo ser revertido. ¡REQUERIRÁ INTERVENCIÓN MANUAL! Error: {revert_error}")
+        raise HTTPException(status.HTTP_504_GATEWAY_TIMEOUT, "Tiempo de espera agotado al contactar servicios internos")
 
     except httpx.HTTPStatusError as e: # Captura el 400 "Insufficient funds"
         status_code = e.response.status_code
-        detail = e.response.json().get("detail", "Error en servicios internos.")
+        detail = error_detail(e.response, "Error en servicios internos.")
         status_final = "FAILED_FUNDS" if status_code == 400 else "FAILED_BALANCE_SVC"
 
         logger.warning(f"Aporte {status_final} para tx {tx_id_sent}: {detail}")
@@ -530,15 +875,9 @@ async def get_my_transactions(
     db: Session = Depends(get_db)
 ):
     logger.info(f"Obteniendo historial de movimientos para user_id: {x_user_id}")
-    query = SimpleStatement(f"""
-        SELECT * FROM {KEYSPACE}.transactions_by_user
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-        LIMIT 50
-    """)
     try:
-        result_set = db.execute(query, (x_user_id,))
-        transactions = [schemas.Transaction(**row._asdict()) for row in result_set]
+        result_set = await cql(db, PREPARED["history_by_user"], (x_user_id,))
+        transactions = [schemas.Transaction.model_validate(row) for row in result_set]
         return transactions
     except Exception as e:
         logger.error(f"Error al obtener transacciones para user_id {x_user_id}: {e}", exc_info=True)
@@ -552,15 +891,9 @@ async def get_group_transactions(
     db: Session = Depends(get_db)
 ):
     logger.info(f"Obteniendo historial de movimientos para group_id: {group_id}")
-    query = SimpleStatement(f"""
-        SELECT * FROM {KEYSPACE}.transactions_by_group
-        WHERE group_id = %s
-        ORDER BY created_at DESC
-        LIMIT 100
-    """)
     try:
-        result_set = db.execute(query, (group_id,))
-        transactions = [schemas.Transaction(**row._asdict()) for row in result_set]
+        result_set = await cql(db, PREPARED["history_by_group"], (group_id,))
+        transactions = [schemas.Transaction.model_validate(row) for row in result_set]
         return transactions
     except Exception as e:
         logger.error(f"Error al obtener transacciones para group_id {group_id}: {e}", exc_info=True)
@@ -575,26 +908,18 @@ async def get_daily_balance(
     now = datetime.now(timezone.utc)
     thirty_days_ago = now - timedelta(days=30)
 
-    query = SimpleStatement(f"""
-        SELECT created_at, type, amount
-        FROM {KEYSPACE}.transactions_by_user
-        WHERE user_id = %s
-        AND created_at >= %s
-        ORDER BY created_at ASC
-    """)
-
     try:
-        result_set = db.execute(query, (user_id, thirty_days_ago))
+        result_set = await cql(db, PREPARED["daily_balance"], (user_id, thirty_days_ago))
 
         daily_balance = defaultdict(Decimal) # Usar Decimal
         running_balance = Decimal('0.0') 
 
         for row in result_set:
-            tx_date = row.created_at.date()
-            if row.type in ["DEPOSIT", "P2P_RECEIVED", "CONTRIBUTION_RECEIVED", "GROUP_WITHDRAWAL"]: # ¡Añadido GROUP_WITHDRAWAL!
-                running_balance += row.amount
-            elif row.type in ["P2P_SENT", "CONTRIBUTION_SENT", "TRANSFER"]:
-                running_balance -= row.amount
+            tx_date = row["created_at"].date()
+            if row["type"] in ["DEPOSIT", "P2P_RECEIVED", "CONTRIBUTION_RECEIVED", "GROUP_WITHDRAWAL"]: # ¡Añadido GROUP_WITHDRAWAL!
+                running_balance += row["amount"]
+            elif row["type"] in ["P2P_SENT", "CONTRIBUTION_SENT", "TRANSFER"]:
+                running_balance -= row["amount"]
             daily_balance[tx_date] = running_balance
 
         data = []
@@ -617,7 +942,7 @@ async def get_daily_balance(
 @app.post("/transfer/p2p", response_model=schemas.Transaction, status_code=status.HTTP_201_CREATED, tags=["Transactions"])
 async def transfer_p2p(
     req: schemas.P2PTransferRequest,
-    idempotency_key: Optional[str] = Header(None, description="Clave única (UUID v4) para idempotencia"),
+    idempotency_uuid: uuid.UUID = Depends(parsed_idempotency_key),
     db: Session = Depends(get_db)
 ):
     """
@@ -629,9 +954,6 @@ async def transfer_p2p(
     4. Si falla el crédito, revierte el débito.
     5. Escribe ambas transacciones en Cassandra (Batch).
     """
-    if idempotency_key is None:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Cabecera Idempotency-Key es requerida")
-
     sender_id = req.user_id # Inyectado por el Gateway
     recipient_phone = req.destination_phone_number
     amount = req.amount
@@ -640,11 +962,14 @@ async def transfer_p2p(
     # (Necesitamos el celular del sender, pero no lo tenemos. Lo omitimos por ahora)
 
     # 1. Verificar Idempotencia
-    existing_tx_id = check_idempotency(db, idempotency_key)
+    cached_tx = IDEMPOTENCY_CACHE.get(idempotency_uuid)
+    if cached_tx is not None: # Réplica reciente: se responde sin tocar Cassandra
+        return cached_tx
+    existing_tx_id = await check_idempotency(db, idempotency_uuid)
     if existing_tx_id:
-        logger.info(f"Transferencia P2P duplicada (Key: {idempotency_key}). Devolviendo tx: {existing_tx_id}")
+        logger.info(f"Transferencia P2P duplicada (Key: {idempotency_uuid}). Devolviendo tx: {existing_tx_id}")
         tx_data = await get_transaction_by_id(db, existing_tx_id)
-        if tx_data: return schemas.Transaction(**tx_data)
+        if tx_data: return cache_replay(idempotency_uuid, tx_data)
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error de idempotencia: Tx original no encontrada")
 
     tx_id_debit = uuid.uuid4() # ID para la transacción de salida
@@ -653,60 +978,62 @@ async def transfer_p2p(
     currency = "PEN"
     recipient_id = None
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            # --- PASO 1: Resolver Destinatario (AUTH SERVICE) ---
-            logger.debug(f"Tx {tx_id_debit}: Buscando destinatario por celular: {recipient_phone}")
-            auth_res = await client.get(f"{AUTH_SERVICE_URL}/users/by-phone/{recipient_phone}")
-            auth_res.raise_for_status() # Lanza 404 si el usuario no existe
+    # Cuerpo del remitente compartido por check, débito y reversión: se serializa una sola vez
+    sender_body = orjson.dumps({"user_id": sender_id, "amount": float(amount)})
+
+    try:
+        # --- PASO 1: Resolver Destinatario (AUTH SERVICE) ---
+        logger.debug(f"Tx {tx_id_debit}: Buscando destinatario por celular: {recipient_phone}")
+        auth_res = await HTTP_CLIENT.get(f"{AUTH_SERVICE_URL}/users/by-phone/{recipient_phone}")
+        auth_res.raise_for_status() # Lanza 404 si el usuario no existe
 
-            recipient_id = int(auth_res.json()["id"])
-            if recipient_id == sender_id:
-                raise HTTPException(status.HTTP_400_BAD_REQUEST, "No puedes transferirte dinero a ti mismo.")
+        recipient_id = int(orjson.loads(auth_res.content)["id"])
+        if recipient_id == sender_id:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "No puedes transferirte dinero a ti mismo.")
 
-            # --- PASO 2: Verificar y Debitar Remitente (BALANCE SERVICE) ---
-            logger.debug(f"Tx {tx_id_debit}: Verificando fondos y debitando a user_id {sender_id}")
+        # --- PASO 2: Verificar y Debitar Remitente (BALANCE SERVICE) ---
+        logger.debug(f"Tx {tx_id_debit}: Verificando fondos y debitando a user_id {sender_id}")
 
-            # Verificamos fondos (el 'check' ya está en el 'debit', pero es buena práctica)
-            check_res = await client.post(f"{BALANCE_SERVICE_URL}/balance/check", json={"user_id": sender_id, "amount": amount})
-            check_res.raise_for_status() # Lanza 400 si no hay fondos
+        # Verificamos fondos (el 'check' ya está en el 'debit', pero es buena práctica)
+        check_res = await HTTP_CLIENT.post(URL_CHECK, content=sender_body, headers=JSON_HEADERS)
+        check_res.raise_for_status() # Lanza 400 si no hay fondos
 
-            # Debitamos
-            debit_res = await client.post(f"{BALANCE_SERVICE_URL}/balance/debit", json={"user_id": sender_id, "amount": amount})
-            debit_res.raise_for_status() # Lanza 400 si falla en la concurrencia
+        # Debitamos
+        debit_res = await HTTP_CLIENT.post(URL_DEBIT, content=sender_body, headers=JSON_HEADERS)
+        debit_res.raise_for_status() # Lanza 400 si falla en la concurrencia
 
-            logger.info(f"Tx {tx_id_debit}: Débito de {amount} a {sender_id} exitoso.")
+        logger.info(f"Tx {tx_id_debit}: Débito de {amount} a {sender_id} exitoso.")
 
-            # --- PASO 3: Acreditar Destinatario (BALANCE SERVICE) ---
+        # --- PASO 3: Acreditar Destinatario (BALANCE SERVICE) ---
+        try:
+            logger.debug(f"Tx {tx_id_credit}: Acreditando {amount} a user_id {recipient_id}")
+            credit_res = await HTTP_CLIENT.post(URL_CREDIT, json={"user_id": recipient_id, "amount": float(amount)})
+            credit_res.raise_for_status()
+            logger.info(f"Tx {tx_id_credit}: Crédito a {recipient_id} exitoso.")
+
+        except Exception as credit_error:
+            # ¡FALLO CRÍTICO! El débito se hizo pero el crédito falló.
+            # --- INICIO DE REVERSIÓN (SAGA) ---
+            logger.error(f"¡FALLO DE SAGA! Tx {tx_id_credit} falló. Revertiendo débito {tx_id_debit} para {sender_id}...")
             try:
-                logger.debug(f"Tx {tx_id_credit}: Acreditando {amount} a user_id {recipient_id}")
-                credit_res = await client.post(f"{BALANCE_SERVICE_URL}/balance/credit", json={"user_id": recipient_id, "amount": amount})
-                credit_res.raise_for_status()
-                logger.info(f"Tx {tx_id_credit}: Crédito a {recipient_id} exitoso.")
+                revert_res = await HTTP_CLIENT.post(URL_CREDIT, content=sender_body, headers=JSON_HEADERS)
+                revert_res.raise_for_status()
+                logger.info(f"Reversión de débito {tx_id_debit} para {sender_id} exitosa.")
+            except Exception as revert_error:
+                logger.critical(f"¡¡FALLO CRÍTICO DE REVERSIÓN!! El débito {tx_id_debit} no pudo ser revertido. ¡REQUERIRÁ INTERVENCIÓN MANUAL! Error: {revert_error}")
 
-            except Exception as credit_error:
-                # ¡FALLO CRÍTICO! El débito se hizo pero el crédito falló.
-                # --- INICIO DE REVERSIÓN (SAGA) ---
-                logger.error(f"¡FALLO DE SAGA! Tx {tx_id_credit} falló. Revertiendo débito {tx_id_debit} para {sender_id}...")
-                try:
-                    revert_res = await client.post(f"{BALANCE_SERVICE_URL}/balance/credit", json={"user_id": sender_id, "amount": amount})
-                    revert_res.raise_for_status()
-                    logger.info(f"Reversión de débito {tx_id_debit} para {sender_id} exitosa.")
-                except Exception as revert_error:
-                    logger.critical(f"¡¡FALLO CRÍTICO DE REVERSIÓN!! El débito {tx_id_debit} no pudo ser revertido. ¡REQUERIRÁ INTERVENCIÓN MANUAL! Error: {revert_error}")
-                
-                raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "El servicio del destinatario falló. La transacción ha sido revertida.")
-
-        except httpx.HTTPStatusError as e:
-            # Error de 'check' (400), 'auth' (404), o 'debit' (400)
-            status_code = e.response.status_code
-            detail = e.response.json().get("detail", "Error en servicios internos.")
-            logger.warning(f"Fallo transferencia P2P: {detail} (Status: {status_code})")
-            raise HTTPException(status_code=status_code, detail=detail)
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "El servicio del destinatario falló. La transacción ha sido revertida.")
+
+    except httpx.HTTPStatusError as e:
+        # Error de 'check' (400), 'auth' (404), o 'debit' (400)
+        status_code = e.response.status_code
+        detail = error_detail(e.response, "Error en servicios internos.")
+        logger.warning(f"Fallo transferencia P2P: {detail} (Status: {status_code})")
+        raise HTTPException(status_code=status_code, detail=detail)
 
-        except httpx.RequestError as e:
-            logger.error(f"Error de red en transferencia P2P: {e}", exc_info=True)
-            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Error de comunicación entre servicios.")
+    except httpx.RequestError as e:
+        logger.error(f"Error de red en transferencia P2P: {e}", exc_info=True)
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Error de comunicación entre servicios.")
 
     # --- PASO 4: Escribir en Cassandra (BATCH) ---
     # --- PASO 4: Escribir en Cassandra (BATCH) ---
@@ -715,29 +1042,31 @@ async def transfer_p2p(
 
         # 1. Lado del REMITENTE (El que envía - P2P_SENT)
         # Guardamos en la tabla principal y en el historial del usuario
-        q_sent_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at) VALUES (%s, %s, 'BDI', %s, 'BDI', %s, 'P2P_SENT', %s, %s, 'COMPLETED', %s, %s)")
-        q_sent_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at) VALUES (%s, %s, %s, 'BDI', %s, 'BDI', %s, 'P2P_SENT', %s, %s, 'COMPLETED', %s)")
         
-        batch.add(q_sent_id, (tx_id_debit, sender_id, str(sender_id), str(recipient_id), amount, currency, now, now))
-        batch.add(q_sent_user, (sender_id, now, tx_id_debit, str(sender_id), str(recipient_id), amount, currency, now))
+        batch.add(PREPARED["insert_p2p_sent_tx"], (tx_id_debit, sender_id, str(sender_id), str(recipient_id), amount, currency, now, now))
+        batch.add(PREPARED["insert_p2p_sent_by_user"], (sender_id, now, tx_id_debit, str(sender_id), str(recipient_id), amount, currency, now))
 
         # 2. Lado del DESTINATARIO (El que recibe - P2P_RECEIVED) - ¡ESTO FALTABA!
-        q_recv_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at) VALUES (%s, %s, 'BDI', %s, 'BDI', %s, 'P2P_RECEIVED', %s, %s, 'COMPLETED', %s, %s)")
-        q_recv_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at) VALUES (%s, %s, %s, 'BDI', %s, 'BDI', %s, 'P2P_RECEIVED', %s, %s, 'COMPLETED', %s)")
         
-        batch.add(q_recv_id, (tx_id_credit, recipient_id, str(sender_id), str(recipient_id), amount, currency, now, now))
-        batch.add(q_recv_user, (recipient_id, now, tx_id_credit, str(sender_id), str(recipient_id), amount, currency, now))
+        batch.add(PREPARED["insert_p2p_received_tx"], (tx_id_credit, recipient_id, str(sender_id), str(recipient_id), amount, currency, now, now))
+        batch.add(PREPARED["insert_p2p_received_by_user"], (recipient_id, now, tx_id_credit, str(sender_id), str(recipient_id), amount, currency, now))
 
-        # Ejecutamos todo junto
-        db.execute(batch)
-        
-        # Guardamos idempotencia
-        db.execute(f"INSERT INTO {KEYSPACE}.idempotency_keys (key, transaction_id) VALUES (%s, %s)", (uuid.UUID(idempotency_key), tx_id_debit))
+        # La clave de idempotencia viaja en el mismo BATCH LOGGED (un solo round-trip)
+        batch.add(PREPARED["insert_idem"], (idempotency_uuid, tx_id_debit))
+        await cql(db, batch)
 
         LEDGER_P2P_TRANSFERS_TOTAL.inc()
 
-        tx_data = await get_transaction_by_id(db, tx_id_debit)
-        return schemas.Transaction(**tx_data)
+        # Devolvemos la tx de SALIDA construida en memoria (sin releerla de Cassandra)
+        tx = schemas.Transaction.model_construct(
+            id=tx_id_debit, user_id=sender_id,
+            source_wallet_type="BDI", source_wallet_id=str(sender_id),
+            destination_wallet_type="BDI", destination_wallet_id=str(recipient_id),
+            type="P2P_SENT", amount=amount, currency=currency, status="COMPLETED",
+            created_at=now, updated_at=now
+        )
+        IDEMPOTENCY_CACHE[idempotency_uuid] = tx
+        return tx
 
     except Exception as e:
         logger.critical(f"¡FALLO CRÍTICO POST-SAGA! Dinero movido pero error en Cassandra: {e}", exc_info=True)
@@ -762,51 +1091,51 @@ async def receive_inbound_transfer(
     currency = "PEN"
     recipient_id = None
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            # PASO 1: Resolver Destinatario (AUTH SERVICE)
-            logger.debug(f"Tx {tx_id}: Buscando destinatario por celular: {req.destination_phone_number}")
-            auth_res = await client.get(f"{AUTH_SERVICE_URL}/users/by-phone/{req.destination_phone_number}")
-            auth_res.raise_for_status()
-            recipient_id = int(auth_res.json()["id"])
-
-            # PASO 2: Acreditar Destinatario (BALANCE SERVICE)
-            logger.debug(f"Tx {tx_id}: Acreditando {req.amount} a user_id {recipient_id}")
-            credit_res = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/credit", 
-                json={"user_id": recipient_id, "amount": req.amount}
-            )
-            credit_res.raise_for_status()
-            logger.info(f"Tx {tx_id}: Crédito a {recipient_id} exitoso.")
+    try:
+        # PASO 1: Resolver Destinatario (AUTH SERVICE)
+        logger.debug(f"Tx {tx_id}: Buscando destinatario por celular: {req.destination_phone_number}")
+        auth_res = await HTTP_CLIENT.get(f"{AUTH_SERVICE_URL}/users/by-phone/{req.destination_phone_number}")
+        auth_res.raise_for_status()
+        recipient_id = int(orjson.loads(auth_res.content)["id"])
+
+        # PASO 2: Acreditar Destinatario (BALANCE SERVICE)
+        logger.debug(f"Tx {tx_id}: Acreditando {req.amount} a user_id {recipient_id}")
+        credit_res = await HTTP_CLIENT.post(
+            URL_CREDIT, 
+            json={"user_id": recipient_id, "amount": float(req.amount)}
+        )
+        credit_res.raise_for_status()
+        logger.info(f"Tx {tx_id}: Crédito a {recipient_id} exitoso.")
 
-        except httpx.HTTPStatusError as e:
-            status_code = e.response.status_code
-            detail = e.response.json().get("detail", "Error en servicios internos.")
-            logger.error(f"Fallo en transferencia entrante: {detail} (Status: {status_code})")
-            raise HTTPException(status_code=status_code, detail=detail)
-        except httpx.RequestError as e:
-            logger.error(f"Error de red en transferencia entrante: {e}", exc_info=True)
-            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Error de comunicación entre servicios.")
+    except httpx.HTTPStatusError as e:
+        status_code = e.response.status_code
+        detail = error_detail(e.response, "Error en servicios internos.")
+        logger.error(f"Fallo en transferencia entrante: {detail} (Status: {status_code})")
+        raise HTTPException(status_code=status_code, detail=detail)
+    except httpx.RequestError as e:
+        logger.error(f"Error de red en transferencia entrante: {e}", exc_info=True)
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Error de comunicación entre servicios.")
 
     # PASO 3: Escribir en Cassandra (¡ÉXITO!)
     try:
         status_final = "COMPLETED"
-        decimal_amount = Decimal(str(req.amount))
         metadata = {"external_tx_id": req.external_transaction_id, "sender_bank": "JavaBank"}
-        metadata_json = json.dumps(metadata)
+        metadata_json = orjson.dumps(metadata).decode()
 
         batch = BatchStatement()
-        q_credit_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'EXTERNAL_BANK', %s, 'BDI', %s, 'DEPOSIT', %s, %s, %s, %s, %s, %s)")
-        q_credit_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, 'EXTERNAL_BANK', %s, 'BDI', %s, 'DEPOSIT', %s, %s, %s, %s, %s)")
-        batch.add(q_credit_id, (tx_id, recipient_id, "JavaBank", str(recipient_id), decimal_amount, currency, status_final, now, now, metadata_json))
-        batch.add(q_credit_user, (recipient_id, now, tx_id, "JavaBank", str(recipient_id), decimal_amount, currency, status_final, now, metadata_json))
-        db.execute(batch)
+        batch.add(PREPARED["insert_inbound_tx"], (tx_id, recipient_id, "JavaBank", str(recipient_id), req.amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_inbound_by_user"], (recipient_id, now, tx_id, "JavaBank", str(recipient_id), req.amount, currency, status_final, now, metadata_json))
+        await cql(db, batch)
 
         DEPOSIT_COUNT.inc() # <-- ¡MÉTRICA CORREGIDA!
 
-        tx_data = await get_transaction_by_id(db, tx_id)
-        if not tx_data: raise Exception("No se pudo recuperar la transacción final")
-        return schemas.Transaction(**tx_data)
+        return schemas.Transaction.model_construct(
+            id=tx_id, user_id=recipient_id,
+            source_wallet_type="EXTERNAL_BANK", source_wallet_id="JavaBank",
+            destination_wallet_type="BDI", destination_wallet_id=str(recipient_id),
+            type="DEPOSIT", amount=req.amount, currency=currency, status=status_final,
+            created_at=now, updated_at=now, metadata=metadata_json
+        )
 
     except Exception as e:
         logger.critical(f"¡FALLO CRÍTICO POST-SAGA! Tx {tx_id} (Entrante) tuvo éxito pero Cassandra falló: {e}", exc_info=True)
@@ -843,57 +1172,55 @@ async def execute_group_withdrawal(
          raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error de configuración interna.")
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-
-            # --- PASO 1: Debitar Saldo del Grupo (BDG) ---
-            # (¡Aquí usamos el endpoint que creamos en el Paso 166!)
-            logger.debug(f"Tx {tx_id_debit}: Debitando {req.amount} de group_id {req.group_id}")
-            debit_res = await client.post(
-                f"{BALANCE_SERVICE_URL}/group_balance/debit",
-                json={"group_id": req.group_id, "amount": req.amount}
-            )
-            debit_res.raise_for_status() # Falla aquí si el GRUPO no tiene fondos
 
-            # --- PASO 2: Acreditar Saldo del Miembro (BDI) ---
-            try:
-                logger.debug(f"Tx {tx_id_credit}: Acreditando {req.amount} a user_id {req.member_user_id}")
-                credit_res = await client.post(
-                    f"{BALANCE_SERVICE_URL}/balance/credit",
-                    json={"user_id": req.member_user_id, "amount": req.amount}
-                )
-                credit_res.raise_for_status()
+        # --- PASO 1: Debitar Saldo del Grupo (BDG) ---
+        # (¡Aquí usamos el endpoint que creamos en el Paso 166!)
+        logger.debug(f"Tx {tx_id_debit}: Debitando {req.amount} de group_id {req.group_id}")
+        debit_res = await HTTP_CLIENT.post(
+            URL_GROUP_DEBIT,
+            json={"group_id": req.group_id, "amount": float(req.amount)}
+        )
+        debit_res.raise_for_status() # Falla aquí si el GRUPO no tiene fondos
 
-            except Exception as credit_error:
-                logger.error(f"¡FALLO DE SAGA (Retiro)! El crédito al miembro {req.member_user_id} falló. Revertiendo débito del grupo {tx_id_debit}...")
-                # ¡REVERSIÓN! Devolvemos el dinero al grupo.
-                async with httpx.AsyncClient() as revert_client:
-                     await revert_client.post(f"{BALANCE_SERVICE_URL}/group_balance/credit", json={"group_id": req.group_id, "amount": req.amount})
-                raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "El servicio de balance del miembro falló. La transacción ha sido revertida.")
+        # --- PASO 2: Acreditar Saldo del Miembro (BDI) ---
+        try:
+            logger.debug(f"Tx {tx_id_credit}: Acreditando {req.amount} a user_id {req.member_user_id}")
+            credit_res = await HTTP_CLIENT.post(
+                URL_CREDIT,
+                json={"user_id": req.member_user_id, "amount": float(req.amount)}
+            )
+            credit_res.raise_for_status()
 
-            # --- PASO 3: Actualizar Saldo Interno (¡La Deuda!) ---
-            try:
-                logger.debug(f"Tx {tx_id_credit}: Actualizando internal_balance (DEUDA) para user {req.member_user_id}")
-                internal_res = await client.post(
-                    f"{GROUP_SERVICE_URL}/groups/{req.group_id}/member_balance",
-                    json={
-                        "user_id_to_update": req.member_user_id, 
-                        "amount": -req.amount # ¡RESTAMOS el monto! (Genera la deuda)
-                    }
-                )
-                internal_res.raise_for_status()
+        except Exception as credit_error:
+            logger.error(f"¡FALLO DE SAGA (Retiro)! El crédito al miembro {req.member_user_id} falló. Revertiendo débito del grupo {tx_id_debit}...")
+            # ¡REVERSIÓN! Devolvemos el dinero al grupo.
+            await HTTP_CLIENT.post(URL_GROUP_CREDIT, json={"group_id": req.group_id, "amount": float(req.amount)})
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "El servicio de balance del miembro falló. La transacción ha sido revertida.")
 
-            except Exception as internal_error:
-                # ¡FALLO CRÍTICO! El dinero se movió pero la deuda no se grabó.
-                # (En un sistema V3.0, revertiríamos todo. Por ahora, solo logueamos.)
-                logger.critical(f"¡FALLO CRÍTICO DE SAGA (Retiro)! El dinero se movió (Tx {tx_id_credit}) pero la deuda en group_service falló: {internal_error}")
-                # No detenemos la transacción, el dinero ya se movió.
+        # --- PASO 3: Actualizar Saldo Interno (¡La Deuda!) ---
+        try:
+            logger.debug(f"Tx {tx_id_credit}: Actualizando internal_balance (DEUDA) para user {req.member_user_id}")
+            internal_res = await HTTP_CLIENT.post(
+                f"{GROUP_SERVICE_URL}/groups/{req.group_id}/member_balance",
+                json={
+                    "user_id_to_update": req.member_user_id, 
+                    "amount": float(-req.amount) # ¡RESTAMOS el monto! (Genera la deuda)
+                }
+            )
+            internal_res.raise_for_status()
 
-            # --- PASO 4: Todo OK ---
-            status_final = "COMPLETED"
+        except Exception as internal_error:
+            # ¡FALLO CRÍTICO! El dinero se movió pero la deuda no se grabó.
+            # (En un sistema V3.0, revertiríamos todo. Por ahora, solo logueamos.)
+            logger.critical(f"¡FALLO CRÍTICO DE SAGA (Retiro)! El dinero se movió (Tx {tx_id_credit}) pero la deuda en group_service falló: {internal_error}")
+            # No detenemos la transacción, el dinero ya se movió.
+
+        # --- PASO 4: Todo OK ---
+        status_final = "COMPLETED"
 
     except httpx.HTTPStatusError as e:
         status_code = e.response.status_code
-        detail = e.response.json().get("detail", "Error en servicios internos.")
+        detail = error_detail(e.response, "Error en servicios internos.")
         logger.warning(f"Saga de retiro fallida (Tx: {tx_id_debit}): {detail} (Status: {status_code})")
         # (Opcional: actualizar el 'withdrawal_request' a REJECTED)
         raise HTTPException(status_code=status_code, detail=detail)
@@ -903,30 +1230,29 @@ async def execute_group_withdrawal(
     # --- PASO 5: Escribir en Cassandra (BATCH) ---
     if status_final == "COMPLETED":
         try:
-            decimal_amount = Decimal(str(req.amount))
             metadata = {"withdrawal_request_id": req.request_id}
-            metadata_json = json.dumps(metadata)
+            metadata_json = orjson.dumps(metadata).decode()
 
             batch = BatchStatement()
 
             # Tx de SALIDA (para el historial del GRUPO)
-            q_debit_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'BDG', %s, 'BDI', %s, 'GROUP_WITHDRAWAL', %s, %s, %s, %s, %s, %s)")
-            q_debit_group = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_group (group_id, created_at, id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, %s, 'BDG', %s, 'BDI', %s, 'GROUP_WITHDRAWAL', %s, %s, %s, %s, %s)")
-            batch.add(q_debit_id, (tx_id_debit, req.member_user_id, str(req.group_id), str(req.member_user_id), decimal_amount, currency, status_final, now, now, metadata_json))
-            batch.add(q_debit_group, (req.group_id, now, tx_id_debit, req.member_user_id, str(req.group_id), str(req.member_user_id), decimal_amount, currency, status_final, now, metadata_json))
+            batch.add(PREPARED["insert_withdrawal_tx"], (tx_id_debit, req.member_user_id, str(req.group_id), str(req.member_user_id), req.amount, currency, status_final, now, now, metadata_json))
+            batch.add(PREPARED["insert_withdrawal_by_group"], (req.group_id, now, tx_id_debit, req.member_user_id, str(req.group_id), str(req.member_user_id), req.amount, currency, status_final, now, metadata_json))
 
             # Tx de ENTRADA (para el historial del MIEMBRO)
-            q_credit_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'BDG', %s, 'BDI', %s, 'DEPOSIT', %s, %s, %s, %s, %s, %s)")
-            q_credit_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, 'BDG', %s, 'BDI', %s, 'DEPOSIT', %s, %s, %s, %s, %s)")
-            batch.add(q_credit_id, (tx_id_credit, req.member_user_id, str(req.group_id), str(req.member_user_id), decimal_amount, currency, status_final, now, now, metadata_json))
-            batch.add(q_credit_user, (req.member_user_id, now, tx_id_credit, str(req.group_id), str(req.member_user_id), decimal_amount, currency, status_final, now, metadata_json))
+            batch.add(PREPARED["insert_withdrawal_credit_tx"], (tx_id_credit, req.member_user_id, str(req.group_id), str(req.member_user_id), req.amount, currency, status_final, now, now, metadata_json))
+            batch.add(PREPARED["insert_withdrawal_credit_by_user"], (req.member_user_id, now, tx_id_credit, str(req.group_id), str(req.member_user_id), req.amount, currency, status_final, now, metadata_json))
 
-            db.execute(batch)
+            await cql(db, batch)
 
             # Devolvemos la transacción de ENTRADA (la que le importa al miembro)
-            tx_data = await get_transaction_by_id(db, tx_id_credit)
-            if not tx_data: raise Exception("No se pudo recuperar la transacción final")
-            return schemas.Transaction(**tx_data)
+            return schemas.Transaction.model_construct(
+                id=tx_id_credit, user_id=req.member_user_id,
+                source_wallet_type="BDG", source_wallet_id=str(req.group_id),
+                destination_wallet_type="BDI", destination_wallet_id=str(req.member_user_id),
+                type="DEPOSIT", amount=req.amount, currency=currency, status=status_final,
+                created_at=now, updated_at=now, metadata=metadata_json
+            )
 
         except Exception as e:
             logger.critical(f"¡FALLO CRÍTICO POST-SAGA! Tx {tx_id_debit} (Retiro) tuvo éxito pero Cassandra falló: {e}", exc_info=True)
@@ -956,40 +1282,40 @@ async def process_loan_disbursement(
     status_final = "COMPLETED"
     
     metadata = {"loan_id": req.loan_id, "description": "Préstamo aprobado"}
-    metadata_json = json.dumps(metadata)
+    metadata_json = orjson.dumps(metadata).decode()
 
     # 1. Mover el dinero (Llamar a Balance Service)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Acreditamos la cuenta del usuario (BDI)
-            response = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/credit",
-                json={"user_id": req.user_id, "amount": req.amount}
-            )
-            response.raise_for_status()
+        # Acreditamos la cuenta del usuario (BDI)
+        response = await HTTP_CLIENT.post(
+            URL_CREDIT,
+            json={"user_id": req.user_id, "amount": float(req.amount)}
+        )
+        response.raise_for_status()
     except Exception as e:
         logger.error(f"Fallo al desembolsar préstamo en Balance Service: {e}")
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error al abonar el préstamo en la cuenta.")
 
     # 2. Registrar en Cassandra
     try:
-        decimal_amount = Decimal(str(req.amount))
         batch = BatchStatement()
 
         # Tx ID Log (Historial General)
-        q_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'PIXEL_BANK', 'MAIN_VAULT', 'BDI', %s, 'LOAN_DISBURSEMENT', %s, %s, %s, %s, %s, %s)")
         
         # Tx User Log (Historial Usuario)
-        q_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, 'PIXEL_BANK', 'MAIN_VAULT', 'BDI', %s, 'LOAN_DISBURSEMENT', %s, %s, %s, %s, %s)")
 
-        batch.add(q_id, (tx_id, req.user_id, str(req.user_id), decimal_amount, currency, status_final, now, now, metadata_json))
-        batch.add(q_user, (req.user_id, now, tx_id, str(req.user_id), decimal_amount, currency, status_final, now, metadata_json))
+        batch.add(PREPARED["insert_loan_disbursement_tx"], (tx_id, req.user_id, str(req.user_id), req.amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_loan_disbursement_by_user"], (req.user_id, now, tx_id, str(req.user_id), req.amount, currency, status_final, now, metadata_json))
 
-        db.execute(batch)
+        await cql(db, batch)
 
-        # Recuperar y devolver
-        tx_data = await get_transaction_by_id(db, tx_id)
-        return schemas.Transaction(**tx_data)
+        return schemas.Transaction.model_construct(
+            id=tx_id, user_id=req.user_id,
+            source_wallet_type="PIXEL_BANK", source_wallet_id="MAIN_VAULT",
+            destination_wallet_type="BDI", destination_wallet_id=str(req.user_id),
+            type="LOAN_DISBURSEMENT", amount=req.amount, currency=currency, status=status_final,
+            created_at=now, updated_at=now, metadata=metadata_json
+        )
 
     except Exception as e:
         logger.critical(f"Dinero entregado pero fallo en Cassandra (Loan Disbursement): {e}", exc_info=True)
@@ -1013,41 +1339,42 @@ async def process_loan_payment(
     status_final = "COMPLETED"
     
     metadata = {"loan_id": req.loan_id, "description": "Pago de préstamo"}
-    metadata_json = json.dumps(metadata)
+    metadata_json = orjson.dumps(metadata).decode()
 
     # 1. Cobrar el dinero (Llamar a Balance Service)
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Debitamos la cuenta del usuario (BDI)
-            response = await client.post(
-                f"{BALANCE_SERVICE_URL}/balance/debit",
-                json={"user_id": req.user_id, "amount": req.amount}
-            )
-            response.raise_for_status() # Esto lanzará error 400 si no hay fondos
+        # Debitamos la cuenta del usuario (BDI)
+        response = await HTTP_CLIENT.post(
+            URL_DEBIT,
+            json={"user_id": req.user_id, "amount": float(req.amount)}
+        )
+        response.raise_for_status() # Esto lanzará error 400 si no hay fondos
     except httpx.HTTPStatusError as e:
-         raise HTTPException(status_code=e.response.status_code, detail=f"Fallo el cobro: {e.response.json().get('detail')}")
+         raise HTTPException(status_code=e.response.status_code, detail=f"Fallo el cobro: {error_detail(e.response)}")
     except Exception as e:
         logger.error(f"Fallo al cobrar préstamo en Balance Service: {e}")
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Error al procesar el cobro del préstamo.")
 
     # 2. Registrar en Cassandra
     try:
-        decimal_amount = Decimal(str(req.amount))
         batch = BatchStatement()
 
         # Tx ID Log
-        q_id = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions (id, user_id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, created_at, updated_at, metadata) VALUES (%s, %s, 'BDI', %s, 'PIXEL_BANK', 'MAIN_VAULT', 'LOAN_PAYMENT', %s, %s, %s, %s, %s, %s)")
         
         # Tx User Log
-        q_user = SimpleStatement(f"INSERT INTO {KEYSPACE}.transactions_by_user (user_id, created_at, id, source_wallet_type, source_wallet_id, destination_wallet_type, destination_wallet_id, type, amount, currency, status, updated_at, metadata) VALUES (%s, %s, %s, 'BDI', %s, 'PIXEL_BANK', 'MAIN_VAULT', 'LOAN_PAYMENT', %s, %s, %s, %s, %s)")
 
-        batch.add(q_id, (tx_id, req.user_id, str(req.user_id), decimal_amount, currency, status_final, now, now, metadata_json))
-        batch.add(q_user, (req.user_id, now, tx_id, str(req.user_id), decimal_amount, currency, status_final, now, metadata_json))
+        batch.add(PREPARED["insert_loan_payment_tx"], (tx_id, req.user_id, str(req.user_id), req.amount, currency, status_final, now, now, metadata_json))
+        batch.add(PREPARED["insert_loan_payment_by_user"], (req.user_id, now, tx_id, str(req.user_id), req.amount, currency, status_final, now, metadata_json))
 
-        db.execute(batch)
+        await cql(db, batch)
 
-        tx_data = await get_transaction_by_id(db, tx_id)
-        return schemas.Transaction(**tx_data)
+        return schemas.Transaction.model_construct(
+            id=tx_id, user_id=req.user_id,
+            source_wallet_type="BDI", source_wallet_id=str(req.user_id),
+            destination_wallet_type="PIXEL_BANK", destination_wallet_id="MAIN_VAULT",
+            type="LOAN_PAYMENT", amount=req.amount, currency=currency, status=status_final,
+            created_at=now, updated_at=now, metadata=metadata_json
+        )
 
     except Exception as e:
         logger.critical(f"Dinero cobrado pero fallo en Cassandra (Loan Payment): {e}", exc_info=True)
@@ -1059,26 +1386,52 @@ async def process_loan_payment(
 
 # --- Endpoint de Salud y Métricas ---
 
+# Cache del último chequeo exitoso de Cassandra (evita un SELECT por cada probe de Docker/LB)
+HEALTH_CACHE_TTL = 5.0 # segundos
+HEALTH_QUERY_TIMEOUT = 2.0 # segundos
+_HEALTH = {"ts": 0.0, "ok": False}
+
 @app.get("/health", tags=["Monitoring"])
-def health_check():
-    """Verifica la salud básica del servicio y la conexión a Cassandra."""
+async def health_check(deep: bool = False):
+    """
+    Verifica la salud básica del servicio y la conexión a Cassandra.
+    El resultado OK se cachea HEALTH_CACHE_TTL segundos; usar ?deep=1 para forzar la consulta.
+    """
+    if not deep and _HEALTH["ok"] and time.monotonic() - _HEALTH["ts"] < HEALTH_CACHE_TTL:
+        return {"status": "ok", "service": "ledger_service", "database": "ok"}
+
     db_status = "ok"
     try:
         if db_session:
-            
-            db_session.execute("SELECT now() FROM system.local", timeout=3.0) 
+            # Consulta asíncrona: no ocupa un hilo del threadpool mientras espera a Cassandra
+            await asyncio.wait_for(cql(db_session, PREPARED["health"]), timeout=HEALTH_QUERY_TIMEOUT)
         else:
             db_status = "error - session not initialized"
             raise HTTPException(status_code=503, detail="Sesión de BD no inicializada")
     except Exception as e:
+        _HEALTH["ok"] = False
         logger.error(f"Health check fallido - Error de Cassandra: {e}", exc_info=True)
         db_status = "error"
         # Devolvemos 503 para que el healthcheck de Docker falle
         raise HTTPException(status_code=503, detail=f"Database (Cassandra) connection error: {e}")
 
+    _HEALTH["ts"] = time.monotonic()
+    _HEALTH["ok"] = True
     return {"status": "ok", "service": "ledger_service", "database": db_status}
 
+# Cache de la serialización de métricas: varios scrapers seguidos comparten el mismo cuerpo
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", "1.0")) # segundos
+METRICS_CACHE = {"ts": 0.0, "body": b""}
+METRICS_LOCK = asyncio.Lock()
+
 @app.get("/metrics", tags=["Monitoring"])
-def metrics():
-    """Expone métricas de la aplicación para Prometheus."""
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file
+async def metrics():
+    """Expone métricas de la aplicación para Prometheus (cacheadas METRICS_CACHE_TTL segundos)."""
+    if time.monotonic() - METRICS_CACHE["ts"] > METRICS_CACHE_TTL:
+        async with METRICS_LOCK:
+            # Re-chequeo: otro scrape pudo regenerarlas mientras esperábamos el lock
+            if time.monotonic() - METRICS_CACHE["ts"] > METRICS_CACHE_TTL:
+                # generate_latest recorre todas las familias: fuera del event loop
+                METRICS_CACHE["body"] = await asyncio.to_thread(generate_latest)
+                METRICS_CACHE["ts"] = time.monotonic()
+    return Response(METRICS_CACHE["body"], media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file
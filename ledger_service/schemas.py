@@ -1,8 +1,33 @@
 """Modelos Pydantic (schemas) para validación de datos de entrada/salida en el Ledger Service."""
 
-from pydantic import BaseModel, Field, UUID4, ConfigDict
+from pydantic import BaseModel, Field, UUID4, ConfigDict, PlainSerializer, BeforeValidator
 from datetime import datetime
-from typing import Optional
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from typing import Annotated, Optional
+
+def to_cents(value):
+    """Redondea el monto a 2 decimales (ROUND_HALF_EVEN) antes de validarlo: 10.005 -> 10.00."""
+    if isinstance(value, (int, float, str)) and not isinstance(value, bool):
+        try:
+            value = Decimal(str(value)) # str() evita arrastrar la expansión binaria del float
+        except InvalidOperation:
+            return value # Pydantic reporta el error de tipo
+    if isinstance(value, Decimal) and value.is_finite():
+        return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+    return value
+
+# MoneyAmount: montos en Decimal de punta a punta (se enlazan tal cual a las columnas DECIMAL de Cassandra).
+# Regla de redondeo (contrato de la API): un monto con más de 2 decimales NO se rechaza; se redondea
+# a centavos con ROUND_HALF_EVEN (redondeo bancario): 10.005 -> 10.00, 10.015 -> 10.02.
+# Tras redondear debe ser > 0 (0.004 -> 0.00 responde 422).
+MONEY_ROUNDING_NOTE = "Se redondea a 2 decimales con ROUND_HALF_EVEN (10.005 -> 10.00, 10.015 -> 10.02)."
+MoneyAmount = Annotated[
+    Decimal,
+    BeforeValidator(to_cents),
+    Field(gt=Decimal("0"), max_digits=18, decimal_places=2, description=f"Monto positivo. {MONEY_ROUNDING_NOTE}"),
+]
+# En la respuesta JSON se mantiene como número (no string) para no romper a los clientes.
+DecimalAsNumber = Annotated[Decimal, PlainSerializer(float, return_type=float, when_used="json")]
 
 # --- Esquemas de Entrada (Input) ---
 
@@ -10,13 +35,13 @@ class DepositRequest(BaseModel):
     """Schema para la solicitud de depósito en una BDI."""
     # user_id será inyectado por el Gateway desde el token JWT.
     user_id: int
-    amount: float = Field(..., gt=0, description="El monto a depositar debe ser positivo.")
+    amount: MoneyAmount = Field(..., description=f"El monto a depositar debe ser positivo. {MONEY_ROUNDING_NOTE}")
 
 class TransferRequest(BaseModel):
     """Schema para la solicitud de transferencia BDI -> BDI (externa)."""
     # user_id será inyectado por el Gateway.
     user_id: int 
-    amount: float = Field(..., gt=0, description="El monto a transferir debe ser positivo.")
+    amount: MoneyAmount = Field(..., description=f"El monto a transferir debe ser positivo. {MONEY_ROUNDING_NOTE}")
     to_bank: str = Field(..., description="Banco destino (ej. 'HAPPY_MONEY')")
     # Identificador del destinatario en el otro banco (número de celular).
     destination_phone_number: str = Field(..., min_length=9, max_length=15, description="Número de celular del destinatario.")
@@ -26,7 +51,7 @@ class ContributionRequest(BaseModel):
     # user_id será inyectado por el Gateway (es quien aporta).
     user_id: int
     group_id: int = Field(..., description="ID del grupo (BDG) que recibe el aporte.")
-    amount: float = Field(..., gt=0, description="El monto a aportar debe ser positivo.")
+    amount: MoneyAmount = Field(..., description=f"El monto a aportar debe ser positivo. {MONEY_ROUNDING_NOTE}")
 
 # --- Esquema de Salida (Respuesta) ---
 
@@ -36,7 +61,7 @@ class P2PTransferRequest(BaseModel):
     """Schema para la solicitud de transferencia P2P (BDI -> BDI)."""
     # user_id (quien envía) vendrá del Gateway.
     user_id: int 
-    amount: float = Field(..., gt=0)
+    amount: MoneyAmount
     destination_phone_number: str = Field(..., min_length=9, max_length=15)
 
 class Transaction(BaseModel):
@@ -51,7 +76,7 @@ class Transaction(BaseModel):
     destination_wallet_type: Optional[str] = None
     destination_wallet_id: Optional[str] = None
     type: str
-    amount: float
+    amount: DecimalAsNumber
     currency: Optional[str] = None
     status: str
     created_at: datetime
@@ -61,13 +86,18 @@ class Transaction(BaseModel):
     # Configuración Pydantic v2+ para mapear desde objetos de base de datos (ORM/Cassandra).
     model_config = ConfigDict(from_attributes=True)
 
+class TransactionResult(Transaction):
+    """Respuesta de depósito/transferencia: la transacción más el saldo BDI resultante."""
+    # Solo viene en la respuesta original; en réplicas idempotentes es None.
+    new_balance: Optional[DecimalAsNumber] = None
+
 
 # En ledger_service/schemas.py
 
 class InboundTransferRequest(BaseModel):
     """Schema para recibir dinero de un banco externo (API v1)."""
     destination_phone_number: str = Field(..., min_length=9, max_length=15)
-    amount: float = Field(..., gt=0)
+    amount: MoneyAmount
     external_transaction_id: str # El ID de la transacción del "otro banco"
 
 # ... (al final del archivo)
@@ -76,7 +106,7 @@ class GroupWithdrawalRequest(BaseModel):
     """Schema interno para que el ledger procese un retiro de grupo."""
     group_id: int
     member_user_id: int # El ID del miembro que RECIBIRÁ el dinero
-    amount: float
+    amount: MoneyAmount
     request_id: int # El ID de la 'withdrawal_request' (de la BD de MariaDB)
 
 
@@ -84,5 +114,5 @@ class GroupWithdrawalRequest(BaseModel):
 class LoanEventRequest(BaseModel):
     """Schema para procesar desembolsos o pagos de préstamos iniciados por Balance Service."""
     user_id: int
-    amount: float = Field(..., gt=0)
+    amount: MoneyAmount
     loan_id: int # Para referenciar el préstamo en los metadatos
\ No newline at end of file
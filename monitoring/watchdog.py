@@ -9,7 +9,9 @@ import requests
 import time
 import os
 import logging
-from datetime import datetime # Importar datetime
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # Carga variables de .env si existen (útil para pruebas locales fuera de Docker)
@@ -35,6 +37,10 @@ MONITORED_CONTAINERS = [
     "n8n" 
 ]
 
+# Sesión HTTP reutilizada para las alertas (mantiene viva la conexión con n8n entre envíos)
+http_session = requests.Session()
+http_session.headers["Content-Type"] = "application/json" # El cuerpo se envía ya serializado
+
 # --- Conexión Inicial a Docker ---
 docker_client = None
 try:
@@ -54,39 +60,52 @@ def check_containers():
     Intenta reiniciar los que no estén 'running' o 'healthy'.
     """
     logger.info("Iniciando ciclo de verificación de contenedores...")
-    for container_name in MONITORED_CONTAINERS:
-        container = None # Resetear para cada contenedor
-        try:
-            container = docker_client.containers.get(container_name)
-            container_status = container.status 
-            
-            # Obtenemos el estado de salud si el contenedor lo tiene definido.
-            health_status = container.attrs.get("State", {}).get("Health", {}).get("Status")
-            
-
-            # Condición de fallo: No está corriendo O está explícitamente no saludable.
-            is_unhealthy = container_status != "running" or health_status == "unhealthy"
-
-            if is_unhealthy:
-                logger.warning(f"⚠️ Contenedor '{container_name}' detectado en estado: {container_status} (Salud: {health_status or 'N/A'}). Intentando reiniciar...")
-                try:
-                    container.restart(timeout=30) # Intenta reiniciar, espera hasta 30s
-                    logger.info(f"Contenedor '{container_name}' reiniciado exitosamente por Watchdog.")
-                    send_alert(container_name, "reiniciado_por_watchdog", f"Estado anterior: {container_status}, Salud anterior: {health_status or 'N/A'}")
-                except Exception as restart_err:
-                    logger.error(f"Error al intentar reiniciar '{container_name}': {restart_err}", exc_info=True)
-                    send_alert(container_name, "fallo_reinicio_watchdog", str(restart_err))
-            
-
-        except docker.errors.NotFound:
-            # El contenedor no existe según Docker.
-            logger.error(f"Contenedor '{container_name}' no encontrado. ¿Está definido correctamente en docker-compose.yml y desplegado?")
-            # Notificamos que no se encontró, podría ser un error de configuración.
-            send_alert(container_name, "no_encontrado_por_watchdog", "docker.errors.NotFound")
-        except Exception as e:
-            # Captura cualquier otro error durante la verificación de este contenedor.
-            logger.error(f"❓ Error inesperado al verificar '{container_name}': {e}", exc_info=True)
-            send_alert(container_name, "error_verificacion_watchdog", str(e))
+    # Cada verificación es una RPC al socket de Docker: se lanzan en paralelo
+    # para que la duración del ciclo no crezca con el número de contenedores.
+    with ThreadPoolExecutor(max_workers=len(MONITORED_CONTAINERS)) as executor:
+        alerts = list(executor.map(check_container, MONITORED_CONTAINERS))
+    # Las alertas se envían desde el hilo principal: http_session no se comparte entre hilos
+    for alert in alerts:
+        if alert:
+            send_alert(*alert)
+
+def check_container(container_name: str):
+    """
+    Verifica un contenedor y lo reinicia si no está 'running' o 'healthy'.
+    Devuelve la alerta a enviar como (container_name, action, detail), o None si está sano.
+    """
+    try:
+        container = docker_client.containers.get(container_name)
+        container_status = container.status 
+        
+        # Obtenemos el estado de salud si el contenedor lo tiene definido.
+        health_status = container.attrs.get("State", {}).get("Health", {}).get("Status")
+        
+
+        # Condición de fallo: No está corriendo O está explícitamente no saludable.
+        is_unhealthy = container_status != "running" or health_status == "unhealthy"
+
+        if is_unhealthy:
+            logger.warning(f"⚠️ Contenedor '{container_name}' detectado en estado: {container_status} (Salud: {health_status or 'N/A'}). Intentando reiniciar...")
+            try:
+                container.restart(timeout=30) # Intenta reiniciar, espera hasta 30s
+                logger.info(f"Contenedor '{container_name}' reiniciado exitosamente por Watchdog.")
+                return (container_name, "reiniciado_por_watchdog", f"Estado anterior: {container_status}, Salud anterior: {health_status or 'N/A'}")
+            except Exception as restart_err:
+                logger.error(f"Error al intentar reiniciar '{container_name}': {restart_err}", exc_info=True)
+                return (container_name, "fallo_reinicio_watchdog", str(restart_err))
+        
+
+    except docker.errors.NotFound:
+        # El contenedor no existe según Docker.
+        logger.error(f"Contenedor '{container_name}' no encontrado. ¿Está definido correctamente en docker-compose.yml y desplegado?")
+        # Notificamos que no se encontró, podría ser un error de configuración.
+        return (container_name, "no_encontrado_por_watchdog", "docker.errors.NotFound")
+    except Exception as e:
+        # Captura cualquier otro error durante la verificación de este contenedor.
+        logger.error(f"❓ Error inesperado al verificar '{container_name}': {e}", exc_info=True)
+        return (container_name, "error_verificacion_watchdog", str(e))
+    return None
 
 def send_alert(container_name: str, action: str, detail: str = "N/A"):
     """
@@ -101,10 +120,10 @@ def send_alert(container_name: str, action: str, detail: str = "N/A"):
         "container": container_name,
         "action": action,
         "detail": detail,
-        "timestamp": datetime.now().isoformat() # Marca de tiempo del evento
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds") # Marca de tiempo del evento (UTC)
     }
     try:
-        response = requests.post(N8N_ALERT_WEBHOOK, json=payload, timeout=10) # Timeout de 10s
+        response = http_session.post(N8N_ALERT_WEBHOOK, data=json.dumps(payload).encode(), timeout=10) # Timeout de 10s
         response.raise_for_status() # Lanza error si n8n devuelve 4xx o 5xx
         logger.info(f"Notificación enviada a n8n para '{container_name}' (Acción: {action})")
     except requests.exceptions.Timeout:
@@ -10,6 +10,7 @@ set -e
 # Ejecuta pytest
 # -v (verbose): Muestra el nombre de cada prueba que se ejecuta (más útil que -q)
 # tests/: La carpeta donde se encuentran todas nuestras pruebas
+# (Con pytest-xdist instalado, tests/conftest.py reparte las pruebas entre workers por defecto)
 pytest -v tests/
 
 echo "¡Todas las pruebas pasaron exitosamente!"
\ No newline at end of file
@@ -5,6 +5,8 @@ Define la URL base del Gateway y crea un usuario de prueba con token al inicio d
 
 import pytest
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import uuid
 from jose import jwt # Necesario para decodificar el token (usa python-jose)
 import os # Para leer JWT_SECRET_KEY del entorno (o default)
@@ -20,11 +22,53 @@ GATEWAY_URL = "http://localhost:8080"
 JWT_SECRET = os.getenv("JWT_SECRET_KEY", "default_insecure_secret_key_change_this_immediately")
 ALGORITHM = "HS256"
 
+@pytest.hookimpl(tryfirst=True)
+def pytest_cmdline_main(config):
+    """
+    Si pytest-xdist está instalado, la corrida por defecto es paralela (-n auto --dist=loadgroup).
+    Un -n explícito (p. ej. -n 0 para depurar) tiene prioridad; sin xdist no cambia nada.
+    """
+    if not config.pluginmanager.hasplugin("xdist") or hasattr(config, "workerinput"):
+        return
+    if config.option.numprocesses is None and config.option.dist == "no":
+        config.option.numprocesses = "auto"
+        config.option.dist = "loadgroup"
+
+
+def cents(amount) -> int:
+    """Convierte un monto (float o string decimal) a centavos enteros para comparar saldos con ==."""
+    return round(float(amount) * 100)
+
+
 @pytest.fixture(scope="session")
-def test_user_token():
+def http():
+    """
+    Fixture de sesión: un único requests.Session para todas las pruebas.
+    Reutiliza las conexiones keep-alive al Gateway en lugar de abrir una por llamada.
+    """
+    session = requests.Session()
+    # Un solo reintento rápido (conexión o 502/503 en GET): bajo carga de xdist, fallar pronto libera el worker
+    retry = Retry(total=1, backoff_factor=0.05, status_forcelist=(502, 503), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retry)
+    session.mount("http://", adapter)
+    yield session
+    session.close()
+
+@pytest.fixture(scope="session", autouse=True)
+def _warmup(http):
+    """
+    Fixture de sesión (autouse): abre la conexión keep-alive al Gateway con un GET barato
+    antes de la primera prueba de cada worker. Si falla, las pruebas reportarán el error real.
+    """
+    try:
+        http.get(f"{GATEWAY_URL}/health", timeout=5)
+    except requests.exceptions.RequestException as e:
+        print(f"\n[Fixture] Warmup del Gateway falló: {e}")
+
+def create_test_user(http) -> dict:
     """
-    Fixture de sesión: Se ejecuta una vez al inicio de todas las pruebas.
-    1. Registra un usuario único para la sesión de pruebas.
+    Crea un usuario de prueba nuevo contra el Gateway:
+    1. Registra un usuario con email único.
     2. Inicia sesión con ese usuario para obtener un token JWT.
     3. Decodifica el token para obtener el user_id.
     4. Devuelve un diccionario con email, user_id y token.
@@ -40,7 +84,7 @@ def test_user_token():
     register_url = f"{GATEWAY_URL}/auth/register"
     try:
         print(f"\n[Fixture] Registrando usuario de prueba: {test_email}...")
-        r_register = requests.post(register_url, json=register_payload, timeout=10)
+        r_register = http.post(register_url, json=register_payload, timeout=10)
         # Permitir 201 (creado) o 400/409 (si ya existe por alguna razón)
         if r_register.status_code not in [201, 400, 409]:
              r_register.raise_for_status() # Lanza excepción para otros errores
@@ -59,7 +103,7 @@ def test_user_token():
     login_url = f"{GATEWAY_URL}/auth/login"
     try:
         print(f"[Fixture] Iniciando sesión como: {test_email}...")
-        r_login = requests.post(login_url, data=login_payload, timeout=10)
+        r_login = http.post(login_url, data=login_payload, timeout=10)
         r_login.raise_for_status() # Falla si login no es 200 OK
         token_data = r_login.json()
         token = token_data.get("access_token")
@@ -85,13 +129,47 @@ def test_user_token():
     return {"email": test_email, "user_id": user_id, "token": token}
 
 
+@pytest.fixture(scope="session")
+def test_user_token(http):
+    """Fixture de sesión: usuario compartido por todas las pruebas (se crea una sola vez)."""
+    return create_test_user(http)
+
+
 @pytest.fixture(scope="session")
 def auth_headers(test_user_token):
     """Fixture simple para obtener las cabeceras de autorización Bearer."""
     return {"Authorization": f"Bearer {test_user_token['token']}"}
 
 
+@pytest.fixture
+def fresh_auth_headers(http):
+    """
+    Fixture por prueba: cabeceras Bearer de un usuario recién creado.
+    Cada prueba opera sobre su propia cuenta, así pueden correr en paralelo (pytest -n auto).
+    """
+    user = create_test_user(http)
+    return {"Authorization": f"Bearer {user['token']}"}
+
+
 @pytest.fixture
 def idempotency_key() -> str:
     """Fixture para generar una clave de idempotencia UUID única para cada prueba."""
-    return str(uuid.uuid4())
\ No newline at end of file
+    return str(uuid.uuid4())
+
+
+@pytest.fixture(scope="module")
+def funded_account(http):
+    """
+    Fixture de módulo: usuario propio con 10000.0 ya depositados (un solo depósito por módulo).
+    Devuelve sus cabeceras Bearer, igual que fresh_auth_headers.
+    """
+    user = create_test_user(http)
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    deposit_headers = {**headers, "Idempotency-Key": str(uuid.uuid4())}
+    try:
+        r = http.post(f"{GATEWAY_URL}/ledger/deposit", json={"amount": 10000.0}, headers=deposit_headers, timeout=15)
+        r.raise_for_status()
+        print(f"\n[Fixture] Cuenta fondeada con 10000.0 (user_id: {user['user_id']}).")
+    except requests.exceptions.RequestException as e:
+        pytest.fail(f"Fallo CRÍTICO en fixture: No se pudo fondear la cuenta de prueba. Error: {e}")
+    return headers
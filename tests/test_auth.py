@@ -7,7 +7,7 @@ import pytest # Importar pytest para mensajes de error más claros
 # Importar la URL base desde conftest
 from conftest import GATEWAY_URL
 
-def test_register_duplicate_email(test_user_token):
+def test_register_duplicate_email(http, test_user_token):
     """
     Verifica que el endpoint /auth/register devuelve un error (400 o 409)
     cuando se intenta registrar un email que ya existe.
@@ -18,7 +18,7 @@ def test_register_duplicate_email(test_user_token):
     register_url = f"{GATEWAY_URL}/auth/register"
 
     print(f"\n[Test] Intentando registrar email duplicado: {existing_email}...")
-    r = requests.post(register_url, json=register_payload, timeout=10)
+    r = http.post(register_url, json=register_payload, timeout=10)
 
     # El servicio auth_service debería devolver 400 (Bad Request) o 409 (Conflict)
     expected_status_codes = [400, 409]
@@ -26,7 +26,7 @@ def test_register_duplicate_email(test_user_token):
         f"Registro duplicado fallido. Esperado status {expected_status_codes}, recibido {r.status_code}. Respuesta: {r.text}"
     print(f"[Test] Registro duplicado correctamente rechazado con status {r.status_code}.")
 
-def test_login_invalid_credentials():
+def test_login_invalid_credentials(http):
     """
     Verifica que el endpoint /auth/login devuelve un error 401 (Unauthorized)
     cuando se proporcionan credenciales incorrectas (email no existente o contraseña errónea).
@@ -37,7 +37,7 @@ def test_login_invalid_credentials():
     login_url = f"{GATEWAY_URL}/auth/login"
 
     print(f"\n[Test] Intentando login con credenciales inválidas: {non_existent_email}...")
-    r = requests.post(login_url, data=login_payload, timeout=10)
+    r = http.post(login_url, data=login_payload, timeout=10)
 
     # Esperamos un error 401 (Unauthorized)
     assert r.status_code == 401, \
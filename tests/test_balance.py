@@ -6,7 +6,11 @@ import pytest # Importar pytest para mensajes de error más claros
 # Importar la URL base y fixtures desde conftest
 from conftest import GATEWAY_URL
 
-def test_get_initial_balance(auth_headers):
+# Todas las pruebas que usan el usuario de sesión van al mismo worker de xdist (--dist=loadgroup),
+# porque asumen saldos absolutos sobre esa cuenta compartida.
+pytestmark = pytest.mark.xdist_group(name="session_user")
+
+def test_get_initial_balance(http, auth_headers):
     """
     Verifica que el endpoint /balance/me devuelve correctamente el saldo inicial (0.0 USD)
     para un usuario recién registrado.
@@ -17,7 +21,7 @@ def test_get_initial_balance(auth_headers):
 
     print(f"\n[Test] Obteniendo saldo inicial para usuario {user_id_for_logging}...")
     try:
-        r = requests.get(balance_url, headers=auth_headers, timeout=10)
+        r = http.get(balance_url, headers=auth_headers, timeout=10)
         r.raise_for_status() # Lanza excepción si el código de estado no es 2xx
         account_data = r.json()
         print(f"[Test] Respuesta de saldo recibida: {account_data}")
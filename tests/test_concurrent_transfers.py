@@ -10,6 +10,10 @@ import logging
 # Importar la URL base y fixtures desde conftest
 from conftest import GATEWAY_URL
 
+# Todas las pruebas que usan el usuario de sesión van al mismo worker de xdist (--dist=loadgroup),
+# porque asumen saldos absolutos sobre esa cuenta compartida.
+pytestmark = pytest.mark.xdist_group(name="session_user")
+
 # Configurar logger
 logger = logging.getLogger(__name__)
 
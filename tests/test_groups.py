@@ -8,9 +8,13 @@ import time
 
 from conftest import GATEWAY_URL, test_user_token, auth_headers
 
+# Todas las pruebas que usan el usuario de sesión van al mismo worker de xdist (--dist=loadgroup),
+# porque asumen saldos absolutos sobre esa cuenta compartida.
+pytestmark = pytest.mark.xdist_group(name="session_user")
+
 # --- Fixture para un SEGUNDO usuario ---
 @pytest.fixture(scope="module")
-def second_user_token():
+def second_user_token(http):
     """
     Fixture de módulo: Crea un SEGUNDO usuario (el invitado) para las pruebas.
     """
@@ -24,14 +28,14 @@ def second_user_token():
     register_payload = {"email": email, "password": password}
     register_url = f"{GATEWAY_URL}/auth/register"
     try:
-        r_register = requests.post(register_url, json=register_payload, timeout=10)
+        r_register = http.post(register_url, json=register_payload, timeout=10)
         r_register.raise_for_status()
         user_id = r_register.json().get("id")
         
         # 2. Login (para que el token sea válido si lo necesitáramos)
         login_url = f"{GATEWAY_URL}/auth/login"
         login_payload = {"username": email, "password": password}
-        r_login = requests.post(login_url, data=login_payload, timeout=10)
+        r_login = http.post(login_url, data=login_payload, timeout=10)
         r_login.raise_for_status()
         token = r_login.json()["access_token"]
         
@@ -43,23 +47,23 @@ def second_user_token():
 
 
 # --- Función Auxiliar (la misma de test_ledger.py) ---
-def get_current_balance(headers: dict) -> float:
+def get_current_balance(http: requests.Session, headers: dict) -> float:
     """Obtiene el saldo BDI actual del usuario autenticado."""
     balance_url = f"{GATEWAY_URL}/balance/me"
     try:
-        r = requests.get(balance_url, headers=headers, timeout=10)
+        r = http.get(balance_url, headers=headers, timeout=10)
         r.raise_for_status()
         return float(r.json()["balance"])
     except Exception as e:
         pytest.fail(f"Fallo al obtener saldo BDI actual: {e}")
         return 0.0
 
-def get_group_balance(group_id: int, headers: dict) -> float:
+def get_group_balance(http: requests.Session, group_id: int, headers: dict) -> float:
     """Obtiene el saldo BDG actual del grupo (LLAMADA DIRECTA A BALANCE_SERVICE)."""
     BALANCE_SERVICE_URL = "http://localhost:8003"
     group_balance_url = f"{BALANCE_SERVICE_URL}/group_balance/{group_id}"
     try:
-        r = requests.get(group_balance_url, timeout=10) # No necesita auth
+        r = http.get(group_balance_url, timeout=10) # No necesita auth
         r.raise_for_status()
         return float(r.json()["balance"])
     except Exception as e:
@@ -69,7 +73,7 @@ def get_group_balance(group_id: int, headers: dict) -> float:
 # --- Pruebas del Flujo Grupal ---
 
 @pytest.fixture(scope="module")
-def setup_funds(auth_headers):
+def setup_funds(http, auth_headers):
     """
     Fixture de módulo: Deposita fondos una vez para todas las pruebas en este archivo.
     """
@@ -81,9 +85,9 @@ def setup_funds(auth_headers):
     payload = {"amount": deposit_amount}
     
     try:
-        r = requests.post(deposit_url, json=payload, headers=headers, timeout=15)
+        r = http.post(deposit_url, json=payload, headers=headers, timeout=15)
         r.raise_for_status()
-        initial_balance = get_current_balance(auth_headers)
+        initial_balance = get_current_balance(http, auth_headers)
         assert initial_balance >= deposit_amount
         print(f"[Fixture BDG] Fondos depositados. Saldo BDI actual: {initial_balance}")
         return initial_balance
@@ -91,7 +95,7 @@ def setup_funds(auth_headers):
         pytest.fail(f"Fallo en fixture BDG: No se pudo depositar fondos. Error: {e}")
 
 @pytest.fixture(scope="module")
-def created_group(auth_headers) -> int:
+def created_group(http, auth_headers) -> int:
     """
     Fixture de módulo: Crea un grupo una vez para todas las pruebas en este archivo.
     Devuelve el ID del grupo creado.
@@ -102,7 +106,7 @@ def created_group(auth_headers) -> int:
     payload = {"name": group_name}
     
     try:
-        r = requests.post(group_url, json=payload, headers=auth_headers, timeout=15)
+        r = http.post(group_url, json=payload, headers=auth_headers, timeout=15)
         r.raise_for_status()
         group_data = r.json()
         group_id = group_data.get("id")
@@ -112,14 +116,14 @@ def created_group(auth_headers) -> int:
     except Exception as e:
         pytest.fail(f"Fallo en fixture BDG: No se pudo crear el grupo. Error: {e}")
 
-def test_group_creation(created_group, auth_headers, test_user_token):
+def test_group_creation(http, created_group, auth_headers, test_user_token):
     """
     Verifica que el grupo se creó correctamente y el líder es miembro.
     """
     print(f"\n[Test] Verificando creación del grupo ID: {created_group}...")
     group_url = f"{GATEWAY_URL}/groups/{created_group}"
     
-    r = requests.get(group_url, headers=auth_headers, timeout=10)
+    r = http.get(group_url, headers=auth_headers, timeout=10)
     r.raise_for_status()
     group_data = r.json()
     
@@ -131,7 +135,7 @@ def test_group_creation(created_group, auth_headers, test_user_token):
     print(f"[Test] Creación de grupo verificada.")
 
 
-def test_invite_member(created_group, auth_headers, second_user_token):
+def test_invite_member(http, created_group, auth_headers, second_user_token):
     """
     Verifica que el líder del grupo puede invitar a un nuevo miembro.
     """
@@ -145,7 +149,7 @@ def test_invite_member(created_group, auth_headers, second_user_token):
     
     try:
         # 1. Enviar la invitación
-        r_invite = requests.post(invite_url, json=payload, headers=auth_headers, timeout=15)
+        r_invite = http.post(invite_url, json=payload, headers=auth_headers, timeout=15)
         r_invite.raise_for_status()
         member_data = r_invite.json()
         
@@ -156,7 +160,7 @@ def test_invite_member(created_group, auth_headers, second_user_token):
         
         # 2. Verificar que el miembro está en la lista del grupo
         group_url = f"{GATEWAY_URL}/groups/{group_id}"
-        r_group = requests.get(group_url, headers=auth_headers, timeout=10)
+        r_group = http.get(group_url, headers=auth_headers, timeout=10)
         r_group.raise_for_status()
         group_data = r_group.json()
         
@@ -173,7 +177,7 @@ def test_invite_member(created_group, auth_headers, second_user_token):
         pytest.fail(f"Fallo inesperado en prueba de invitación: {e}")
 
 
-def test_group_contribution(setup_funds, created_group, auth_headers, idempotency_key):
+def test_group_contribution(http, setup_funds, created_group, auth_headers, idempotency_key):
     """
     Verifica el flujo de aporte BDI -> BDG.
     (Esta prueba no cambia)
@@ -192,15 +196,15 @@ def test_group_contribution(setup_funds, created_group, auth_headers, idempotenc
     
     try:
         # 1. Obtener saldos iniciales
-        initial_bdi_balance = get_current_balance(auth_headers)
-        initial_bdg_balance = get_group_balance(group_id, auth_headers)
+        initial_bdi_balance = get_current_balance(http, auth_headers)
+        initial_bdg_balance = get_group_balance(http, group_id, auth_headers)
         print(f"[Test] Aporte BDG: Saldo BDI inicial = {initial_bdi_balance}")
         print(f"[Test] Aporte BDG: Saldo BDG inicial = {initial_bdg_balance}")
         
         assert initial_bdi_balance >= contribution_amount, "Fondos BDI insuficientes para iniciar la prueba"
         
         # 2. Realizar el aporte
-        r_contribute = requests.post(contribute_url, json=payload, headers=headers, timeout=15)
+        r_contribute = http.post(contribute_url, json=payload, headers=headers, timeout=15)
         r_contribute.raise_for_status()
         tx_data = r_contribute.json()
         print(f"[Test] Aporte BDG: Respuesta recibida -> {tx_data}")
@@ -211,14 +215,14 @@ def test_group_contribution(setup_funds, created_group, auth_headers, idempotenc
         assert tx_data.get("amount") == contribution_amount
         
         # 4. Verificar saldo BDI final (reducción)
-        final_bdi_balance = get_current_balance(auth_headers)
+        final_bdi_balance = get_current_balance(http, auth_headers)
         expected_bdi_balance = initial_bdi_balance - contribution_amount
         print(f"[Test] Aporte BDG: Saldo BDI final = {final_bdi_balance} (Esperado: {expected_bdi_balance})")
         assert final_bdi_balance == pytest.approx(expected_bdi_balance), "El saldo BDI no se redujo correctamente."
         
         # 5. Verificar saldo BDG final (aumento)
         time.sleep(1) 
-        final_bdg_balance = get_group_balance(group_id, auth_headers)
+        final_bdg_balance = get_group_balance(http, group_id, auth_headers)
         expected_bdg_balance = initial_bdg_balance + contribution_amount
         print(f"[Test] Aporte BDG: Saldo BDG final = {final_bdg_balance} (Esperado: {expected_bdg_balance})")
         assert final_bdg_balance == pytest.approx(expected_bdg_balance), "El saldo BDG no aumentó correctamente."
@@ -2,21 +2,26 @@
 
 import requests
 import pytest
-import uuid
 import logging # Añadido para logging en pruebas
 
 # Importar la URL base y fixtures desde conftest
-from conftest import GATEWAY_URL
+from conftest import GATEWAY_URL, cents, create_test_user
 
 # Configurar un logger simple para las pruebas
 logger = logging.getLogger(__name__)
 
+# (conexión, lectura) en segundos: conectar falla rápido; la lectura cubre el deadline del ledger (5s)
+TIMEOUT = (2, 10)
+
+# Grupos de xdist (--dist=loadgroup): los depósitos por defecto, las transferencias aparte
+pytestmark = pytest.mark.xdist_group(name="ledger_default")
+
 # --- Función Auxiliar ---
-def get_current_balance(headers: dict) -> float:
+def get_current_balance(http: requests.Session, headers: dict) -> float:
     """Obtiene el saldo actual del usuario autenticado llamando al endpoint /balance/me."""
     balance_url = f"{GATEWAY_URL}/balance/me"
     try:
-        r = requests.get(balance_url, headers=headers, timeout=10)
+        r = http.get(balance_url, headers=headers, timeout=TIMEOUT)
         r.raise_for_status()
         balance = r.json()["balance"]
         logger.info(f"Saldo actual obtenido: {balance}")
@@ -27,42 +32,62 @@ def get_current_balance(headers: dict) -> float:
 
 # --- Pruebas ---
 
-def test_deposit_updates_balance(auth_headers, idempotency_key):
+@pytest.mark.parametrize("deposit_amount,duplicate", [(150.75, False), (50.0, True)], ids=["single", "duplicate"])
+def test_deposit(http, fresh_auth_headers, idempotency_key, deposit_amount, duplicate):
     """
-    Verifica el flujo de depósito BDI:
+    Verifica el flujo de depósito BDI (y su idempotencia con duplicate=True):
     1. Obtiene el saldo inicial.
     2. Realiza un depósito usando una clave de idempotencia.
-    3. Verifica que la transacción se completó.
-    4. Obtiene el saldo final y verifica que aumentó correctamente.
+    3. Verifica que la transacción se completó y el saldo resultante.
+    4. Si duplicate: repite el MISMO depósito con la MISMA clave, verifica que
+       devuelva el mismo ID y que el saldo solo haya aumentado UNA VEZ.
     """
     deposit_url = f"{GATEWAY_URL}/ledger/deposit"
-    deposit_amount = 150.75
-    headers = {**auth_headers, "Idempotency-Key": idempotency_key}
+    headers = {**fresh_auth_headers, "Idempotency-Key": idempotency_key}
     payload = {"amount": deposit_amount} # El Gateway inyectará el user_id
 
-    print(f"\n[Test] Depósito: Verificando actualización de saldo...")
+    print(f"\n[Test] Depósito (duplicate={duplicate}): Verificando actualización de saldo...")
     try:
-        initial_balance = get_current_balance(auth_headers)
+        initial_balance = get_current_balance(http, fresh_auth_headers)
         print(f"[Test] Depósito: Saldo inicial = {initial_balance}")
+        expected_balance = cents(initial_balance) + cents(deposit_amount) # Solo debe aumentar una vez
 
         print(f"[Test] Depósito: Realizando depósito de {deposit_amount} con key {idempotency_key}...")
-        r_deposit = requests.post(deposit_url, json=payload, headers=headers, timeout=15)
-        r_deposit.raise_for_status()
+        r_deposit = http.post(deposit_url, json=payload, headers=headers, timeout=TIMEOUT)
+        assert r_deposit.status_code == 201, \
+            f"Depósito rechazado. Esperado status 201, recibido {r_deposit.status_code}. Respuesta: {r_deposit.text}"
         deposit_tx = r_deposit.json()
         print(f"[Test] Depósito: Respuesta recibida -> {deposit_tx}")
 
+        assert deposit_tx.get("id"), "El depósito no devolvió un ID de transacción."
         assert deposit_tx.get("status") == "COMPLETED", \
             f"Estado de transacción incorrecto. Esperado 'COMPLETED', recibido '{deposit_tx.get('status')}'"
         assert deposit_tx.get("amount") == deposit_amount, \
             f"Monto de transacción incorrecto. Esperado {deposit_amount}, recibido {deposit_tx.get('amount')}"
 
-        # --- Verificación Crítica del Saldo ---
-        final_balance = get_current_balance(auth_headers)
-        print(f"[Test] Depósito: Saldo final = {final_balance}")
-        expected_balance = initial_balance + deposit_amount
-        # Usamos pytest.approx para comparar floats con una pequeña tolerancia
-        assert final_balance == pytest.approx(expected_balance), \
-               f"Saldo incorrecto después del depósito. Esperado ~{expected_balance}, recibido {final_balance}"
+        # --- Verificación Crítica del Saldo (el ledger devuelve el saldo resultante) ---
+        final_balance = float(deposit_tx["new_balance"])
+        print(f"[Test] Depósito: Saldo tras el depósito = {final_balance}")
+        # Comparamos en centavos enteros: sin tolerancias de float
+        assert cents(final_balance) == expected_balance, \
+               f"Saldo incorrecto después del depósito. Esperado {expected_balance} centavos, recibido {final_balance}"
+
+        if duplicate:
+            # --- Segundo Depósito (Duplicado) ---
+            print(f"[Test] Idempotencia Depósito: Realizando segundo depósito (duplicado) con la misma key...")
+            r2 = http.post(deposit_url, json=payload, headers=headers, timeout=TIMEOUT)
+            # Esperamos 201 con la transacción original
+            assert r2.status_code == 201, \
+                f"Depósito duplicado rechazado. Esperado status 201, recibido {r2.status_code}. Respuesta: {r2.text}"
+            tx2_id = r2.json().get("id")
+            assert deposit_tx["id"] == tx2_id, \
+                f"Idempotencia fallida: IDs de transacción diferentes. Original: {deposit_tx['id']}, Duplicado: {tx2_id}"
+
+            # La réplica no trae new_balance: se consulta el saldo real
+            final_balance = get_current_balance(http, fresh_auth_headers)
+            print(f"[Test] Idempotencia Depósito: Saldo final = {final_balance}")
+            assert cents(final_balance) == expected_balance, \
+                   f"Idempotencia fallida: Saldo incorrecto. Esperado {expected_balance} centavos, recibido {final_balance}"
 
         print(f"[Test] Depósito: Saldo actualizado correctamente.")
 
@@ -77,71 +102,66 @@ def test_deposit_updates_balance(auth_headers, idempotency_key):
         pytest.fail(f"Fallo inesperado en prueba de depósito: {e}")
 
 
-def test_deposit_idempotency(auth_headers, idempotency_key):
+@pytest.mark.parametrize("sent_amount,expected_cents", [(10.005, 1000), (10.015, 1002)], ids=["half_to_even_down", "half_to_even_up"])
+def test_deposit_rounds_amount_to_cents(http, fresh_auth_headers, idempotency_key, sent_amount, expected_cents):
     """
-    Verifica la idempotencia del depósito:
-    1. Obtiene saldo inicial.
-    2. Realiza un depósito con una clave.
-    3. Realiza el MISMO depósito con la MISMA clave.
-    4. Verifica que el ID de transacción devuelto sea el mismo.
-    5. Verifica que el saldo solo haya aumentado UNA VEZ.
+    Verifica que un monto con más de 2 decimales se acepta (no 422) y se redondea
+    a centavos con ROUND_HALF_EVEN: 10.005 -> 10.00 y 10.015 -> 10.02
+    (el segundo caso descarta un simple truncamiento).
     """
     deposit_url = f"{GATEWAY_URL}/ledger/deposit"
-    deposit_amount = 50.0
-    headers = {**auth_headers, "Idempotency-Key": idempotency_key} # Usar la MISMA clave
-    payload = {"amount": deposit_amount}
+    headers = {**fresh_auth_headers, "Idempotency-Key": idempotency_key}
 
-    print(f"\n[Test] Idempotencia Depósito: Verificando depósito único...")
-    try:
-        initial_balance = get_current_balance(auth_headers)
-        print(f"[Test] Idempotencia Depósito: Saldo inicial = {initial_balance}")
-
-        # --- Primer Depósito ---
-        print(f"[Test] Idempotencia Depósito: Realizando primer depósito de {deposit_amount} con key {idempotency_key}...")
-        r1 = requests.post(deposit_url, json=payload, headers=headers, timeout=15)
-        r1.raise_for_status()
-        tx1 = r1.json()
-        tx1_id = tx1.get("id")
-        assert tx1_id, "El primer depósito no devolvió un ID de transacción."
-        print(f"[Test] Idempotencia Depósito: Primer depósito OK (ID: {tx1_id}).")
-
-        # --- Segundo Depósito (Duplicado) ---
-        print(f"[Test] Idempotencia Depósito: Realizando segundo depósito (duplicado) con la misma key...")
-        r2 = requests.post(deposit_url, json=payload, headers=headers, timeout=15)
-        r2.raise_for_status() # Esperamos que devuelva 2xx (la transacción original)
-        tx2 = r2.json()
-        tx2_id = tx2.get("id")
-        assert tx2_id, "El segundo depósito (duplicado) no devolvió un ID de transacción."
-        print(f"[Test] Idempotencia Depósito: Segundo depósito OK (ID: {tx2_id}).")
-
-        # --- Verificaciones ---
-        assert tx1_id == tx2_id, \
-            f"Idempotencia fallida: IDs de transacción diferentes. Original: {tx1_id}, Duplicado: {tx2_id}"
-
-        final_balance = get_current_balance(auth_headers)
-        print(f"[Test] Idempotencia Depósito: Saldo final = {final_balance}")
-        expected_balance = initial_balance + deposit_amount # Solo debe aumentar una vez
-
-        assert final_balance == pytest.approx(expected_balance), \
-               f"Idempotencia fallida: Saldo incorrecto. Esperado ~{expected_balance}, recibido {final_balance}"
-
-        print(f"[Test] Idempotencia Depósito: Verificada correctamente.")
-
-    except requests.exceptions.Timeout:
-         pytest.fail(f"Fallo en prueba de idempotencia: Timeout al llamar a {deposit_url}.")
-    except requests.exceptions.RequestException as e:
-        error_text = e.response.text if e.response else "Sin respuesta"
-        pytest.fail(f"Fallo en prueba de idempotencia: Error en {deposit_url}. Status: {e.response.status_code if e.response else 'N/A'}. Error: {e}\nRespuesta: {error_text}")
-    except (AssertionError, KeyError) as e:
-        pytest.fail(f"Fallo en prueba de idempotencia: Verificación fallida - {e}")
-    except Exception as e:
-        pytest.fail(f"Fallo inesperado en prueba de idempotencia: {e}")
+    print("\n[Test] Depósito con 3 decimales: Verificando redondeo a centavos...")
+    r_deposit = http.post(deposit_url, json={"amount": sent_amount}, headers=headers, timeout=TIMEOUT)
+    assert r_deposit.status_code == 201, \
+        f"Depósito rechazado. Esperado status 201, recibido {r_deposit.status_code}. Respuesta: {r_deposit.text}"
+    deposit_tx = r_deposit.json()
+    assert cents(deposit_tx["amount"]) == expected_cents, \
+        f"Monto mal redondeado. Enviado {sent_amount}, esperado {expected_cents} centavos, recibido {deposit_tx['amount']}"
+    assert cents(deposit_tx["new_balance"]) == expected_cents, \
+        f"Saldo incorrecto tras el depósito redondeado. Esperado {expected_cents} centavos, recibido {deposit_tx['new_balance']}"
 
 
-def test_transfer_bdi_to_bdi_updates_balance(auth_headers, idempotency_key):
+def test_deposit_retry_after_failed_credit(http, idempotency_key):
+    """
+    Verifica que un crédito fallido NO deja la clave de idempotencia ligada:
+    1. Deposita (directo al Ledger Service) a una cuenta inexistente -> Balance Service falla.
+    2. Reintenta con la MISMA clave para un usuario real (vía Gateway).
+    3. El reintento vuelve a acreditar: 201 COMPLETED y el saldo sube.
+    """
+    LEDGER_SERVICE_URL = "http://localhost:8002"
+    user = create_test_user(http)
+    user_headers = {"Authorization": f"Bearer {user['token']}"}
+    deposit_amount = 25.0
+
+    print("\n[Test] Reintento tras crédito fallido: Verificando que la clave no quede ligada...")
+    r_failed = http.post(
+        f"{LEDGER_SERVICE_URL}/deposit",
+        json={"user_id": 999_999_999, "amount": deposit_amount}, # Sin cuenta en Balance Service
+        headers={"Idempotency-Key": idempotency_key}, timeout=TIMEOUT
+    )
+    assert r_failed.status_code >= 400, \
+        f"El depósito a una cuenta inexistente debía fallar. Recibido {r_failed.status_code}. Respuesta: {r_failed.text}"
+
+    initial_balance = get_current_balance(http, user_headers)
+    r_retry = http.post(
+        f"{GATEWAY_URL}/ledger/deposit", json={"amount": deposit_amount},
+        headers={**user_headers, "Idempotency-Key": idempotency_key}, timeout=TIMEOUT
+    )
+    assert r_retry.status_code == 201, \
+        f"El reintento con la misma clave debía acreditar. Recibido {r_retry.status_code}. Respuesta: {r_retry.text}"
+    retry_tx = r_retry.json()
+    assert retry_tx["status"] == "COMPLETED", f"Estado incorrecto en el reintento: {retry_tx['status']}"
+    assert cents(retry_tx["new_balance"]) == cents(initial_balance) + cents(deposit_amount), \
+        f"El reintento no acreditó. Saldo inicial {initial_balance}, recibido {retry_tx['new_balance']}"
+
+
+@pytest.mark.xdist_group(name="ledger_transfers")
+def test_transfer_bdi_to_bdi_updates_balance(http, funded_account, idempotency_key):
     """
     Verifica el flujo de transferencia BDI -> BDI (a Happy Money simulado):
-    1. Asegura fondos depositando primero.
+    1. Parte de una cuenta ya fondeada (fixture 'funded_account').
     2. Obtiene saldo inicial.
     3. Realiza la transferencia usando API interbancaria (número de celular).
     4. Verifica que la transacción se completó.
@@ -151,7 +171,7 @@ def test_transfer_bdi_to_bdi_updates_balance(auth_headers, idempotency_key):
     transfer_amount = 120.25
     destination_phone = "987654321" # Número de prueba válido para el simulador
 
-    headers = {**auth_headers, "Idempotency-Key": idempotency_key}
+    headers = {**funded_account, "Idempotency-Key": idempotency_key}
     payload = {
         "amount": transfer_amount,
         "to_bank": "HAPPY_MONEY", # Banco destino correcto
@@ -160,21 +180,15 @@ def test_transfer_bdi_to_bdi_updates_balance(auth_headers, idempotency_key):
 
     print(f"\n[Test] Transferencia BDI->BDI: Verificando actualización de saldo...")
     try:
-        # 1. Asegurar fondos suficientes
-        print("[Test] Transferencia BDI->BDI: Depositando fondos iniciales...")
-        deposit_key = str(uuid.uuid4())
-        deposit_headers = {**auth_headers, "Idempotency-Key": deposit_key}
-        # Depositamos suficiente para cubrir la transferencia y posibles pruebas anteriores
-        requests.post(f"{GATEWAY_URL}/ledger/deposit", json={"amount": transfer_amount + 200.0}, headers=deposit_headers, timeout=15).raise_for_status()
-
-        initial_balance = get_current_balance(auth_headers)
+        initial_balance = get_current_balance(http, funded_account)
         print(f"[Test] Transferencia BDI->BDI: Saldo inicial = {initial_balance}")
         assert initial_balance >= transfer_amount, "Error en la preparación: no hay suficientes fondos depositados para la prueba."
 
         # 3. Realizar la transferencia
         print(f"[Test] Transferencia BDI->BDI: Realizando transferencia de {transfer_amount} a {destination_phone}...")
-        r_transfer = requests.post(transfer_url, json=payload, headers=headers, timeout=20) # Mayor timeout para llamadas externas
-        r_transfer.raise_for_status()
+        r_transfer = http.post(transfer_url, json=payload, headers=headers, timeout=TIMEOUT)
+        assert r_transfer.status_code == 201, \
+            f"Transferencia rechazada. Esperado status 201, recibido {r_transfer.status_code}. Respuesta: {r_transfer.text}"
         transfer_tx = r_transfer.json()
         print(f"[Test] Transferencia BDI->BDI: Respuesta recibida -> {transfer_tx}")
 
@@ -186,11 +200,11 @@ def test_transfer_bdi_to_bdi_updates_balance(auth_headers, idempotency_key):
              "ID de destino (teléfono) incorrecto en la transacción registrada."
 
         # 5. --- Verificación Crítica del Saldo ---
-        final_balance = get_current_balance(auth_headers)
+        final_balance = float(transfer_tx["new_balance"])
         print(f"[Test] Transferencia BDI->BDI: Saldo final = {final_balance}")
-        expected_balance = initial_balance - transfer_amount
-        assert final_balance == pytest.approx(expected_balance), \
-               f"Saldo incorrecto después de la transferencia. Esperado ~{expected_balance}, recibido {final_balance}"
+        expected_balance = cents(initial_balance) - cents(transfer_amount)
+        assert cents(final_balance) == expected_balance, \
+               f"Saldo incorrecto después de la transferencia. Esperado {expected_balance} centavos, recibido {final_balance}"
 
         print(f"[Test] Transferencia BDI->BDI: Saldo actualizado correctamente.")
 
@@ -205,17 +219,19 @@ def test_transfer_bdi_to_bdi_updates_balance(auth_headers, idempotency_key):
         pytest.fail(f"Fallo inesperado en prueba de transferencia BDI->BDI: {e}")
 
 
-def test_transfer_insufficient_funds(auth_headers, idempotency_key):
+@pytest.mark.fast
+@pytest.mark.xdist_group(name="ledger_transfers")
+def test_transfer_insufficient_funds(http, fresh_auth_headers, idempotency_key):
     """
     Verifica que una transferencia BDI -> BDI falla con un error 400 (Bad Request)
     si el usuario no tiene fondos suficientes.
     """
     transfer_url = f"{GATEWAY_URL}/ledger/transfer"
-    headers = {**auth_headers, "Idempotency-Key": idempotency_key}
+    headers = {**fresh_auth_headers, "Idempotency-Key": idempotency_key}
 
     print(f"\n[Test] Transferencia Fondos Insuficientes: Verificando rechazo...")
     try:
-        current_balance = get_current_balance(auth_headers)
+        current_balance = get_current_balance(http, fresh_auth_headers)
         print(f"[Test] Transferencia Fondos Insuficientes: Saldo actual = {current_balance}")
         # Intentamos transferir más de lo que hay
         transfer_amount = current_balance + 100.0
@@ -227,16 +243,16 @@ def test_transfer_insufficient_funds(auth_headers, idempotency_key):
             "destination_phone_number": "912345678" # Un número cualquiera
         }
 
-        r_transfer = requests.post(transfer_url, json=payload, headers=headers, timeout=15)
+        r_transfer = http.post(transfer_url, json=payload, headers=headers, timeout=TIMEOUT)
 
         # Esperamos un error 400 Bad Request (devuelto por balance_service y propagado por ledger_service/gateway)
         assert r_transfer.status_code == 400, \
             f"Fallo en prueba de fondos insuficientes. Esperado status 400, recibido {r_transfer.status_code}. Respuesta: {r_transfer.text}"
 
         # --- Verificación Crítica: El saldo NO debe cambiar ---
-        final_balance = get_current_balance(auth_headers)
+        final_balance = get_current_balance(http, fresh_auth_headers)
         print(f"[Test] Transferencia Fondos Insuficientes: Saldo final = {final_balance}")
-        assert final_balance == pytest.approx(current_balance), \
+        assert cents(final_balance) == cents(current_balance), \
             f"El saldo cambió incorrectamente después de una transferencia fallida. Inicial: {current_balance}, Final: {final_balance}"
 
         print(f"[Test] Transferencia Fondos Insuficientes: Rechazo y saldo verificado correctamente.")
@@ -250,8 +266,8 @@ def test_transfer_insufficient_funds(auth_headers, idempotency_key):
              pytest.fail(f"Fallo en prueba de fondos insuficientes: Error inesperado en {transfer_url}. Status: {e.response.status_code if e.response else 'N/A'}. Error: {e}\nRespuesta: {error_text}")
         else:
              # Si SÍ es 400, la prueba pasa (verificamos saldo igualmente por si acaso)
-             final_balance = get_current_balance(auth_headers)
-             assert final_balance == pytest.approx(current_balance), \
+             final_balance = get_current_balance(http, fresh_auth_headers)
+             assert cents(final_balance) == cents(current_balance), \
                  f"El saldo cambió incorrectamente después de una transferencia fallida (error 400). Inicial: {current_balance}, Final: {final_balance}"
              print(f"[Test] Transferencia Fondos Insuficientes: Rechazo 400 recibido y saldo verificado correctamente.")
     except (AssertionError, KeyError) as e: